@@ -1,8 +1,18 @@
 #!/usr/bin/env python3
+import os
+import sys
 import argparse
+import threading
+from queue import Queue, Empty
+from functools import partial
+from contextlib import nullcontext
 from multiprocessing import Pool, current_process
 
-import boto3
+# Makes the shared cloud_scripts package importable when the script is run directly from the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from cloud_scripts import session, metrics, inventory  # noqa: E402
+from cloud_scripts.cognito import iter_users_sharded  # noqa: E402
 
 
 def parse_cmd():
@@ -27,44 +37,76 @@ def parse_cmd():
         required=True
     )
 
+    p.add_argument(
+        '--shard-workers',
+        help='List users with this number of concurrent workers, splitting the pool '
+             'into disjoint "sub" prefix ranges (default - serial listing)',
+        default=None
+    )
+
     p.add_argument(
         '--processes',
         help='Number of processes which should handle the deletion (default - 1)',
         default=1
     )
 
+    p.add_argument(
+        '--threads',
+        help='Number of threads (one client and one connection each) which should handle the deletion '
+             'in a single process; overrides --processes',
+        default=None
+    )
+
+    p.add_argument(
+        '--inventory',
+        help='Cache the listed users in this SQLite file, so a rerun within --inventory-ttl skips listing '
+             'and continues with users which are not processed yet'
+    )
+
+    p.add_argument(
+        '--inventory-ttl',
+        help='Seconds after which cached listings are listed again (default - 900)',
+        type=int,
+        default=900
+    )
+
+    p.add_argument(
+        '--metrics-file',
+        help='Save per-operation API call metrics to this file at exit: '
+             '".prom" - Prometheus text format, any other extension - JSON'
+    )
+
     args = p.parse_args()
 
     return args
 
 
-def create_aws_session(region, profile_name):
+def create_aws_session(region, profile_name, concurrency=None):
     # Creates global cognito session, as multiprocessing doesnt support taking boto3.client
     # object as parameter.
-    # Objects passed to mp.starmap() must be pickle-able, and AWS clients are not pickle-able
+    # Objects passed to mp.starmap() must be pickle-able, and AWS clients are not pickle-able,
+    # so every pool process calls this function in its initializer
     global cognito
 
-    if profile_name:
-        print(f'Using profile {profile_name}\n')
-        my_session = boto3.session.Session(
-            region_name=region,
-            profile_name=profile_name
-        )
-        cognito = my_session.client('cognito-idp')
-    else:
-        print('Using default profile')
-        cognito = boto3.client('cognito-idp', region_name = region)
+    session.create_aws_session(region, profile_name)
 
+    cognito = session.client('cognito-idp', concurrency)
 
-def get_users(user_pool_id):
+
+def get_users(user_pool_id, shard_workers=None):
     paginator = cognito.get_paginator('list_users')
     users_list = []
 
     print('Getting a list of users from Cognito')
 
-    response_iterator = paginator.paginate(
-        UserPoolId=user_pool_id,
-    )
+    if shard_workers:
+        response_iterator = (
+            {'Users': users} for users, _ in iter_users_sharded(cognito, user_pool_id, shard_workers)
+        )
+    else:
+        response_iterator = paginator.paginate(
+            UserPoolId=user_pool_id,
+        )
 
     for page in response_iterator:
         users_list.extend(page['Users'])
@@ -76,6 +118,7 @@ def get_users(user_pool_id):
 
 def delete_worker(user_pool_id, users_list):
     p = current_process()
+    deleted = []
     for user in users_list:
         print(
             f"Deteling user - {user['Username']} - in process: {p.name} - pid: {p.pid}")
@@ -84,38 +127,134 @@ def delete_worker(user_pool_id, users_list):
                 UserPoolId=user_pool_id,
                 Username=user['Username']
             )
-        except Exception as e:
+        except cognito.exceptions.UserNotFoundException:
             print(f"User {user['Username']} is not found")
+        except Exception as e:
+            print(f"Failed to delete user {user['Username']}. Error: {e}")
+            continue
+
+        deleted.append(user['Username'])
+
+    return deleted, metrics.drain()
+
+
+def delete_users(user_pool_id, users, process_num, region, profile_name, cache=None):
+    # Processes take users in chunks, and users of every finished chunk are marked done right away,
+    # so an interrupted run keeps its progress
+    chunk_size = max(1, min(inventory.DONE_CHUNK_SIZE, -(-len(users) // process_num)))
+    chunks = [users[i:i + chunk_size] for i in range(0, len(users), chunk_size)]
+
+    with Pool(process_num, initializer=create_aws_session, initargs=(region, profile_name)) as p:
+        for deleted, operations in p.imap_unordered(partial(delete_worker, user_pool_id), chunks):
+            metrics.merge(operations)
+
+            if cache:
+                cache.mark_done('cognito-users', deleted, scope=user_pool_id)
+
+
+def thread_delete_worker(user_pool_id, usernames, failed, done):
+    name = threading.current_thread().name
+    client = session.thread_client('cognito-idp')
+
+    while True:
+        try:
+            username = usernames.get_nowait()
+        except Empty:
+            return
+
+        print(f"Deleting user - {username} - in thread: {name}")
+        try:
+            client.admin_delete_user(
+                UserPoolId=user_pool_id,
+                Username=username
+            )
+        except client.exceptions.UserNotFoundException:
+            print(f"User {username} is not found")
+        except Exception as e:
+            print(f"Failed to delete user {username}. Error: {e}")
+            failed.append(username)
+            continue
+
+        if done:
+            done.add([username])
+
 
+def thread_delete_users(user_pool_id, users, threads_num, cache=None):
+    usernames = Queue()
+    for user in users:
+        usernames.put(user['Username'])
 
-def split_list(lst, n):
-    return [lst[i::n] for i in range(n)]
+    failed = []
 
+    # Deleted users are marked done in chunks as threads go
+    with cache.marker('cognito-users', scope=user_pool_id) if cache else nullcontext() as done:
+        # Every thread creates its own client with a single connection
+        workers = [
+            threading.Thread(
+                target=thread_delete_worker,
+                args=(user_pool_id, usernames, failed, done),
+                name=f'worker-{i}'
+            )
+            for i in range(threads_num)
+        ]
+        for w in workers:
+            w.start()
+
+        try:
+            for w in workers:
+                w.join()
+        except KeyboardInterrupt:
+            # Workers stop after the user they are deleting, so it is marked done before the rest is flushed
+            while True:
+                try:
+                    usernames.get_nowait()
+                except Empty:
+                    break
 
-def delete_users(user_pool_id, users, process_num):
-    users_list_divided = split_list(users, process_num)
+            for w in workers:
+                w.join()
 
-    with Pool(process_num) as p:
-        # Assign each part of users_list_divided [[part 1], [part 2], ...] to different process
-        p.starmap(delete_worker, [(user_pool_id, part) for part in users_list_divided])
+            raise
+
+    if failed:
+        raise RuntimeError(f'Failed to delete {len(failed)} users')
 
 
 def main():
     args = parse_cmd()
+    metrics.enable(args.metrics_file)
 
     region = args.region
     user_pool_id = args.userpool
     profile_name = args.profile_name
     process_num = int(args.processes)
+    shard_workers = int(args.shard_workers) if args.shard_workers else None
 
-    create_aws_session(region, profile_name)
+    create_aws_session(region, profile_name, shard_workers)
 
     try:
-        users = get_users(user_pool_id)
-        delete_users(user_pool_id, users, process_num)
+        if args.inventory:
+            # Users listed again with the same UserLastModifiedDate stay done when the cached listing expires
+            cache = inventory.open_inventory(args.inventory, args.inventory_ttl)
+            users = cache.get(
+                'cognito-users',
+                lambda: get_users(user_pool_id, shard_workers),
+                lambda user: user['Username'],
+                lambda user: user.get('UserLastModifiedDate'),
+                scope=user_pool_id
+            )
+        else:
+            cache = None
+            users = get_users(user_pool_id, shard_workers)
+
+        if args.threads:
+            thread_delete_users(user_pool_id, users, int(args.threads), cache)
+        else:
+            delete_users(user_pool_id, users, process_num, region, profile_name, cache)
         print("Successfully deleted all users!")
     except Exception as e:
         print(f'Smth went wrong. Error: \n{e}')
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -1,22 +1,31 @@
+import os
+import sys
 import json
+import base64
 import argparse
-from time import time
+import threading
+from time import monotonic
+from datetime import datetime, timezone
+from queue import Queue
 from os.path import isfile
-from functools import wraps
 
-import boto3
-from boto3.dynamodb.types import TypeDeserializer
+# Makes the shared cloud_scripts package importable when the script is run directly from the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
 
+from cloud_scripts import session, metrics, sink  # noqa: E402
+from cloud_scripts.deserializer import ItemDeserializer  # noqa: E402
+from cloud_scripts.cognito import iter_users_sharded  # noqa: E402
 
-def timer(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        ts = time()
-        result = f(*args, **kwargs)
-        te = time()
-        print(f'Function "{f.__name__}" took {te-ts} seconds to run\n')
-        return result
-    return wrapper
+
+# Minimal number of seconds between two checkpoints of the streamed output
+CHECKPOINT_INTERVAL = 5
+# Parquet column types of Cognito attribute data types. Numbers may have a fraction, so they are doubles
+COGNITO_COLUMN_TYPES = {
+    'String': 'str',
+    'Number': 'float',
+    'Boolean': 'bool',
+    'DateTime': 'datetime',
+}
 
 
 def parse_cmd():
@@ -47,6 +56,19 @@ def parse_cmd():
         help='The ID of the User Pool, where users are stored'
     )
 
+    p.add_argument(
+        '--shard-workers',
+        help='List Cognito users with this number of concurrent workers, splitting the pool '
+             'into disjoint "sub" prefix ranges (default - serial listing)',
+        default=None
+    )
+
+    p.add_argument(
+        '--segments',
+        help='Number of parallel scan segments used to read the DynamoDB table (default - 1)',
+        default=1
+    )
+
     p.add_argument(
         '-o',
         '--output',
@@ -54,28 +76,72 @@ def parse_cmd():
         default='users_data'
     )
 
+    p.add_argument(
+        '-f',
+        '--format',
+        help='Format of the result file: "json" - single JSON document, written at the end; '
+             '"jsonl" - one user per line, written page by page; '
+             '"parquet" - columnar file written row group by row group, requires pyarrow (default - json)',
+        choices=['json', 'jsonl', 'parquet'],
+        default='json'
+    )
+
+    p.add_argument(
+        '--row-group-size',
+        help='Number of users in a Parquet row group; column types are inferred from the first one (default - 100000)',
+        default=100000
+    )
+
+    p.add_argument(
+        '--compression',
+        help='Compression codec of Parquet columns, or of the jsonl output: gzip or zstd, zstd requires Python 3.14 '
+             'or the zstandard package (default - snappy for Parquet, no compression for jsonl)',
+        choices=['snappy', 'zstd', 'gzip', 'brotli', 'lz4', 'none'],
+        default=None
+    )
+
+    p.add_argument(
+        '--max-part-bytes',
+        help='jsonl format only: split the output into numbered parts of about this size in bytes (after compression), '
+             'listed in a .manifest.json file next to them'
+    )
+
+    p.add_argument(
+        '--max-part-records',
+        help='jsonl format only: split the output into numbered parts of at most this number of users, '
+             'listed in a .manifest.json file next to them'
+    )
+
+    p.add_argument(
+        '--native-numbers',
+        help='Convert DynamoDB numbers to int/float, written as JSON numbers, instead of Decimal, written as strings',
+        action='store_true'
+    )
+
+    p.add_argument(
+        '--compact',
+        help='Write compact, unsorted JSON lines (jsonl format only)',
+        action='store_true'
+    )
+
+    p.add_argument(
+        '--metrics-file',
+        help='Save per-operation API call metrics to this file at exit: '
+             '".prom" - Prometheus text format, any other extension - JSON'
+    )
+
     args = p.parse_args()
 
     return args
 
 
-def create_aws_session(region, profile_name):
+def create_aws_session(region, profile_name, concurrency=None):
     global dynamodb, cognito
 
-    if profile_name:
-        print(f'Using profile {profile_name}\n')
-        my_session = boto3.session.Session(
-            region_name=region,
-            profile_name=profile_name
-        )
+    session.create_aws_session(region, profile_name)
 
-        dynamodb = my_session.client('dynamodb')
-        cognito = my_session.client('cognito-idp')
-    else:
-        print('Using default profile')
-
-        dynamodb = boto3.client('dynamodb', region_name=region)
-        cognito = boto3.client('cognito-idp', region_name=region)
+    dynamodb = session.client('dynamodb', concurrency)
+    cognito = session.client('cognito-idp', concurrency)
 
 
 def save_data_to_json(data, filename):
@@ -83,55 +149,284 @@ def save_data_to_json(data, filename):
         json.dump(data, file, indent=4, sort_keys=True, default=str)
 
 
-@timer
-def get_users_from_cognito(user_pool_id):
-    paginator = cognito.get_paginator('list_users')
+def load_checkpoint(filename):
+    with open(filename) as file:
+        return json.load(file)
+
+
+def save_checkpoint(checkpoint, filename):
+    # Write to a temporary file first, so an interrupted save never leaves a broken checkpoint
+    with open(filename + '.tmp', 'w') as file:
+        json.dump(checkpoint, file)
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(filename + '.tmp', filename)
+
+
+def stream_data_to_jsonl(pages, filename, compact=False, checkpoint_file=None, checkpoint=None):
+    # pages yield (users, state) pairs, where state is the position to resume listing from after the page.
+    # With a checkpoint, output is appended after the rows it has recorded
+    if compact:
+        encode = json.JSONEncoder(separators=(',', ':'), default=str).encode
+    else:
+        encode = json.JSONEncoder(sort_keys=True, default=str).encode
+
+    count = checkpoint['rows'] if checkpoint else 0
+    saved_at = monotonic()
+
+    if checkpoint_file and not isfile(checkpoint_file):
+        save_checkpoint(checkpoint, checkpoint_file)
+
+    with open(filename, 'a' if checkpoint else 'w') as file:
+        if checkpoint:
+            # Drop rows written after the last checkpoint, they will be listed again
+            file.truncate(checkpoint['offset'])
+            file.seek(checkpoint['offset'])
+
+        for page, state in pages:
+            file.write(''.join(encode(item) + '\n' for item in page))
+            count += len(page)
+
+            print(f'Written {count} users', end='\r', flush=True)
+
+            if checkpoint_file and monotonic() - saved_at >= CHECKPOINT_INTERVAL:
+                file.flush()
+                os.fsync(file.fileno())
+
+                save_checkpoint({**checkpoint, 'rows': count, 'offset': file.tell(), 'state': state}, checkpoint_file)
+                saved_at = monotonic()
+
+    if checkpoint_file and isfile(checkpoint_file):
+        os.remove(checkpoint_file)
+
+    print(f'\nNumber of written users - {count}')
+
+    return count
+
+
+def stream_data_to_parquet(pages, filename, row_group_size, compression, columns=()):
+    # Written to a temporary file, so an interrupted extraction does not leave a valid-looking partial file
+    from cloud_scripts.parquet import ParquetSink
+
+    tmp_filename = filename + '.tmp'
+
+    try:
+        with ParquetSink(tmp_filename, row_group_size, compression, columns) as sink:
+            for page, _ in pages:
+                sink.write(page)
+
+                print(f'Listed {sink.rows_written + len(sink.rows)} users', end='\r', flush=True)
+    except BaseException:
+        if isfile(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+    os.replace(tmp_filename, filename)
+
+    print(f'\nNumber of written users - {sink.rows_written}')
+
+    return sink.rows_written
+
+
+def stream_data_to_sink(pages, output):
+    # Encoding and compression run on the sink's thread, so listing is not slowed down by them
+    count = 0
+
+    with output:
+        for page, _ in pages:
+            output.write(page)
+            count += len(page)
+
+            print(f'Listed {count} users', end='\r', flush=True)
+
+    print(f'\nNumber of written users - {count} in {len(output.parts)} parts, listed in {output.manifest_file}')
+
+    return count
+
+
+def get_cognito_columns(user_pool_id):
+    # Flattened users get a column for every attribute of the pool schema, also when no listed user has it,
+    # typed by the data type of the attribute
+    schema = cognito.describe_user_pool(UserPoolId=user_pool_id)['UserPool'].get('SchemaAttributes', [])
+
+    return {
+        attribute['Name'].replace('custom:', ''): COGNITO_COLUMN_TYPES.get(attribute.get('AttributeDataType'), 'str')
+        for attribute in schema
+    }
+
+
+def parse_cognito_value(value, column_type):
+    # Cognito returns every attribute value as a string; values which don't parse are kept as they are
+    # and written to the extra column
+    try:
+        if column_type == 'float':
+            return float(value)
+        if column_type == 'bool' and value.lower() in ('true', 'false'):
+            return value.lower() == 'true'
+        if column_type == 'datetime':
+            parsed = datetime.fromisoformat(value)
+            return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    except ValueError:
+        pass
+
+    return value
+
+
+def typed_pages(pages, columns):
+    # Converts attribute values of flattened users to the types of their columns
+    typed = {name: column_type for name, column_type in columns.items() if column_type != 'str'}
+
+    for page, state in pages:
+        for user in page:
+            for name, column_type in typed.items():
+                if isinstance(user.get(name), str):
+                    user[name] = parse_cognito_value(user[name], column_type)
+
+        yield page, state
 
+
+def flatten_user(user):
+    # Transform Cognito nested dicts structure to flat dict
+    for item in user.pop('Attributes'):
+        user[item['Name'].replace('custom:','')] = item['Value']
+
+    return user
+
+
+def iter_users_from_cognito(user_pool_id, shard_workers=None, state=None):
+    if shard_workers:
+        for users, shards_state in iter_users_sharded(cognito, user_pool_id, shard_workers, state):
+            yield [flatten_user(user) for user in users], shards_state
+
+        return
+
+    # A checkpoint saved after the last page has no token left, the listing is finished
+    if state and state['token'] is None:
+        return
+
+    token_args = {'PaginationToken': state['token']} if state else {}
+
+    while True:
+        response = cognito.list_users(
+            UserPoolId=user_pool_id,
+            **token_args
+        )
+        token = response.get('PaginationToken')
+
+        yield [flatten_user(user) for user in response['Users']], {'token': token}
+
+        if not token:
+            break
+
+        token_args = {'PaginationToken': token}
+
+
+def get_users_from_cognito(user_pool_id, shard_workers=None):
     users_list = []
 
     print('Getting a list of users from Cognito\n')
-    response_iterator = paginator.paginate(
-        UserPoolId=user_pool_id
-    )
 
-    for page in response_iterator:
-        users_list.extend(page['Users'])
+    for page, _ in iter_users_from_cognito(user_pool_id, shard_workers):
+        users_list.extend(page)
 
     print(f'Number of users in userpool "{user_pool_id}" - {len(users_list)}')
 
-    # Transform Cognito nested dicts structure to flat dict
-    for user in users_list:
-        for item in user['Attributes']:
-            user[item['Name'].replace('custom:','')] = item['Value']
+    return users_list
 
-        del user['Attributes']
 
-    return users_list
+def encode_key(key):
+    # Binary key attributes are not JSON serializable
+    return {k: {'B': base64.b64encode(v['B']).decode()} if 'B' in v else v for k, v in key.items()}
 
 
-@timer
-def get_users_from_dynamodb(table_name):
-    print('Gettings a list of users from DynamoDB table\n')
+def decode_key(key):
+    return {k: {'B': base64.b64decode(v['B'])} if 'B' in v else v for k, v in key.items()}
 
-    paginator = dynamodb.get_paginator('scan')
-    response_iterator = paginator.paginate(
-        TableName=table_name
-    )
 
-    response = []
-    for page in response_iterator:
-        response.extend(page['Items'])
+def scan_pages(table_name, segment=0, total_segments=1, start_key=None):
+    # Yields items of every page along with the key to continue the scan from (None after the last page)
+    segment_args = {}
+    if total_segments > 1:
+        segment_args = {'Segment': segment, 'TotalSegments': total_segments}
+
+    while True:
+        start_args = {'ExclusiveStartKey': start_key} if start_key else {}
+
+        response = dynamodb.scan(
+            TableName=table_name,
+            **segment_args,
+            **start_args
+        )
+        start_key = response.get('LastEvaluatedKey')
+
+        yield response['Items'], start_key
+
+        if not start_key:
+            break
+
+
+def scan_segment_to_queue(table_name, segment, total_segments, start_key, pages):
+    try:
+        for items, last_key in scan_pages(table_name, segment, total_segments, start_key):
+            pages.put((segment, items, last_key))
+    except Exception as e:
+        pages.put(e)
+    finally:
+        pages.put(None)
+
+
+def iter_raw_pages_from_dynamodb(table_name, segments=1, state=None):
+    # Yields items of every page along with the scan position of every segment after the page;
+    # a segment mapped to None is finished
+    if state is not None:
+        positions = {int(segment): key for segment, key in state['segments'].items()}
+    else:
+        positions = {segment: {} for segment in range(segments)}
+
+    # Segments are scanned in parallel threads, pages are yielded in the order they arrive
+    pages = Queue(maxsize=segments * 2)
+    running = 0
+    for segment, key in positions.items():
+        if key is None:
+            continue
+
+        threading.Thread(
+            target=scan_segment_to_queue,
+            args=(table_name, segment, segments, decode_key(key) or None, pages),
+            daemon=True
+        ).start()
+        running += 1
+
+    while running:
+        page = pages.get()
+
+        if page is None:
+            running -= 1
+        elif isinstance(page, Exception):
+            raise page
+        else:
+            segment, items, last_key = page
+            positions[segment] = encode_key(last_key) if last_key else None
 
+            yield items, {'segments': dict(positions)}
+
+
+def iter_users_from_dynamodb(table_name, segments=1, state=None, native_numbers=False):
     # Deserialize the DynamoDB response to get rid of variable type declarations
-    deserializer = TypeDeserializer()
-    deserialized_response = []
+    deserialize = ItemDeserializer(native_numbers)
 
-    for record in response:
-        flat_record = {k: deserializer.deserialize(v) for k, v in record.items()}
-        deserialized_response.append(flat_record)
+    for items, positions in iter_raw_pages_from_dynamodb(table_name, segments, state):
+        yield [deserialize(record) for record in items], positions
+
+
+def get_users_from_dynamodb(table_name, segments=1, native_numbers=False):
+    print('Gettings a list of users from DynamoDB table\n')
+
+    deserialized_response = []
+    for page, _ in iter_users_from_dynamodb(table_name, segments, native_numbers=native_numbers):
+        deserialized_response.extend(page)
 
-    del response
-    
     print(f'Number of DynamoDB items - {len(deserialized_response)}')
 
     return deserialized_response
@@ -139,19 +434,75 @@ def get_users_from_dynamodb(table_name):
 
 def main():
     args = parse_cmd()
+    metrics.enable(args.metrics_file)
 
     region = args.region
     profile_name = args.profile_name
+    shard_workers = int(args.shard_workers) if args.shard_workers else None
     dynamodb_name = args.dynamodb
     userpool_id = args.userpool
-    result_file = args.output + '.json'
+    result_file = f'{args.output}.{args.format}'
+
+    checkpoint_file = f'./{result_file}.checkpoint'
+
+    # Compressed or split jsonl output is written through a sink, without checkpoints
+    compression = None if args.compression == 'none' else args.compression
+    max_bytes = int(args.max_part_bytes) if args.max_part_bytes else None
+    max_records = int(args.max_part_records) if args.max_part_records else None
+    use_sink = args.format == 'jsonl' and bool(compression or max_bytes or max_records)
+
+    if args.format != 'parquet' and compression not in (None, 'gzip', 'zstd'):
+        print(f'{compression} compression is supported only for Parquet; use gzip or zstd for jsonl')
+
+        return
+
+    if args.format == 'json' and (compression or max_bytes or max_records):
+        print('Compressed or split output is supported for jsonl and parquet formats, use -f jsonl')
+
+        return
+
+    if use_sink and compression == 'zstd' and not sink.zstd_available():
+        print('zstd compression requires Python 3.14 or the zstandard package: pip install "cloud-scripts[zstd]"')
+
+        return
+
+    if use_sink and isfile(f'./{args.output}.manifest.json'):
+        print('File with users data already exists in target directory, exiting')
+
+        return
 
-    create_aws_session(region, profile_name)
+    if args.format == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            print('Parquet format requires pyarrow, install it with: pip install "cloud-scripts[parquet]"')
+
+            return
+
+    # Scan segments or listing shards share one client
+    create_aws_session(region, profile_name, max(int(args.segments), shard_workers or 1))
 
     users_list = []
-    
+
+    if dynamodb_name:
+        source = {'dynamodb': dynamodb_name, 'segments': int(args.segments)}
+    else:
+        source = {'userpool': userpool_id, 'sharded': bool(shard_workers)}
+
+    # Streamed output which has a checkpoint next to it was interrupted and can be resumed
+    checkpoint = None
+    if args.format == 'jsonl' and not use_sink and isfile(checkpoint_file):
+        checkpoint = load_checkpoint(checkpoint_file)
+
+        if checkpoint['source'] != source:
+            print(f'Checkpoint {checkpoint_file} was created for {checkpoint["source"]}, exiting')
+
+            return
+
+        print(f'Resuming extraction, {checkpoint["rows"]} users were already written\n')
+
     # Check if file with raw users data exists
-    if not isfile(result_file):
+    if not isfile(result_file) or checkpoint:
         if not dynamodb_name and not userpool_id:
             print('Either specify Cognito userpool ID or DynamoDB Table name to extract users from')
 
@@ -160,13 +511,56 @@ def main():
             print('Either specify Cognito userpool ID or DynamoDB Table name to extract users from; not both')
 
             return
-        elif dynamodb_name:
-            users_list = get_users_from_dynamodb(dynamodb_name)
-
-        elif userpool_id:
-            users_list = get_users_from_cognito(userpool_id)
-
-        save_data_to_json(users_list, f'./{result_file}')
+        elif use_sink:
+            if dynamodb_name:
+                pages = iter_users_from_dynamodb(dynamodb_name, int(args.segments), native_numbers=args.native_numbers)
+            else:
+                pages = iter_users_from_cognito(userpool_id, shard_workers)
+
+            if args.compact:
+                encode = json.JSONEncoder(separators=(',', ':'), default=str).encode
+            else:
+                encode = json.JSONEncoder(sort_keys=True, default=str).encode
+
+            output = sink.JsonLinesSink(f'./{result_file}', compression, max_bytes, max_records, encode)
+            stream_data_to_sink(pages, output)
+
+        elif args.format == 'jsonl':
+            state = checkpoint['state'] if checkpoint else None
+
+            if dynamodb_name:
+                pages = iter_users_from_dynamodb(dynamodb_name, int(args.segments), state, args.native_numbers)
+            else:
+                pages = iter_users_from_cognito(userpool_id, shard_workers, state)
+
+            stream_data_to_jsonl(
+                pages,
+                f'./{result_file}',
+                args.compact,
+                checkpoint_file,
+                checkpoint or {'source': source, 'rows': 0, 'offset': 0, 'state': None}
+            )
+
+        elif args.format == 'parquet':
+            # Numbers are written to int64/float64 columns
+            if dynamodb_name:
+                pages = iter_users_from_dynamodb(dynamodb_name, int(args.segments), native_numbers=True)
+                columns = ()
+            else:
+                columns = get_cognito_columns(userpool_id)
+                pages = typed_pages(iter_users_from_cognito(userpool_id, shard_workers), columns)
+
+            stream_data_to_parquet(
+                pages, f'./{result_file}', int(args.row_group_size), args.compression or 'snappy', columns
+            )
+
+        else:
+            if dynamodb_name:
+                users_list = get_users_from_dynamodb(dynamodb_name, int(args.segments), args.native_numbers)
+            else:
+                users_list = get_users_from_cognito(userpool_id, shard_workers)
+
+            save_data_to_json(users_list, f'./{result_file}')
     else:
         print('File with users data already exists in target directory, exiting')
         
@@ -1,8 +1,41 @@
+import os
+import sys
+import re
+import json
+import math
+import random
 import argparse
+import threading
+from time import monotonic, sleep
+from decimal import Decimal
+from queue import Queue, Full
+from contextlib import nullcontext
 from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
-from boto3.dynamodb.types import TypeDeserializer
+# Makes the shared cloud_scripts package importable when the script is run directly from the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from cloud_scripts import session, metrics, inventory  # noqa: E402
+
+
+BATCH_SIZE = 25
+MAX_RETRIES = 10
+BACKOFF_BASE = 0.05
+BACKOFF_CAP = 20
+# Default throughput a new on-demand table can absorb without pre-warming
+ON_DEMAND_WRITE_UNITS = 4000
+THROTTLING_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+TRANSIENT_ERRORS = ('InternalServerError', 'ServiceUnavailable')
+# Batch writes are retried only by CapacityWriter: botocore retrying them as well would hide throttling from
+# its counter, multiply attempts, and its adaptive rate limiter would compete with the WCU budget
+WRITE_RETRIES = {'mode': 'standard', 'total_max_attempts': 1}
+# Rough time DynamoDB takes to delete and create a table, and to build every global secondary index of the new table
+RECREATE_SECONDS = 60
+RECREATE_INDEX_SECONDS = 30
+# Seconds between table status checks and the longest wait for a table to be deleted or become active
+WAIT_DELAY = 5
+WAIT_TIMEOUT = 1800
 
 
 def parse_cmd():
@@ -30,103 +63,859 @@ def parse_cmd():
     p.add_argument(
         '-k',
         '--primary-key',
-        help='The name of the primary key in the DynamoDB table',
-        required=True
+        help='The name of the partition key of the DynamoDB table; optional, the key schema is read from the table'
+    )
+
+    p.add_argument(
+        '--filter',
+        help='Delete only records matching this DynamoDB condition expression, evaluated server-side, '
+             'f.e. "tenant = :t AND created < :c". When it compares the partition key for equality, '
+             'the table is queried instead of scanned'
+    )
+
+    p.add_argument(
+        '--values',
+        help='Values of placeholders used in --filter as a JSON object, f.e. \'{":t": "acme", ":c": 1700000000}\''
+    )
+
+    p.add_argument(
+        '--names',
+        help='Attribute names of placeholders used in --filter as a JSON object, f.e. \'{"#s": "status"}\''
     )
 
     p.add_argument(
         '--process-num',
-        help='Number of processes that should handle deletion (one process uses up to 200 WCU); default: 1',
+        help='Number of processes that should handle deletion; default: 1',
         default=1
     )
 
+    p.add_argument(
+        '--segments',
+        help='Number of parallel scan segments (Segment/TotalSegments); default: 1, or --process-num when it is set',
+        default=None
+    )
+
+    p.add_argument(
+        '--stream',
+        help='Delete records while the table is being scanned, without loading the whole table into memory',
+        action='store_true'
+    )
+
+    p.add_argument(
+        '--workers',
+        help='Number of threads that should handle deletion in stream mode; default: 4',
+        default=4
+    )
+
+    p.add_argument(
+        '--queue-size',
+        help='Maximum number of scanned pages waiting for deletion in stream mode; default: 16',
+        default=16
+    )
+
+    p.add_argument(
+        '--wcu',
+        help='Write capacity units per second that deletion may consume in total (across all processes)',
+        default=None
+    )
+
+    p.add_argument(
+        '--capacity-fraction',
+        help='Fraction of the table write capacity (provisioned or on-demand limit) that deletion may consume, f.e. 0.5',
+        default=None
+    )
+
+    p.add_argument(
+        '--strategy',
+        help='How records are deleted: "scan" - scan the table and delete every record, '
+             '"recreate" - delete the table and create it again with the same definition, '
+             '"auto" - whichever is estimated to be faster (default - scan)',
+        choices=('scan', 'recreate', 'auto'),
+        default='scan'
+    )
+
+    p.add_argument(
+        '--dry-run',
+        help='Print the estimated time and capacity of both strategies without deleting anything',
+        action='store_true'
+    )
+
+    p.add_argument(
+        '--inventory',
+        help='Cache the keys of scanned records in this SQLite file, so a rerun within --inventory-ttl skips listing '
+             'and continues with records which are not deleted yet; only without --stream and --process-num'
+    )
+
+    p.add_argument(
+        '--inventory-ttl',
+        help='Seconds after which cached listings are listed again (default - 900)',
+        type=int,
+        default=900
+    )
+
+    p.add_argument(
+        '--metrics-file',
+        help='Save per-operation API call metrics to this file at exit: '
+             '".prom" - Prometheus text format, any other extension - JSON'
+    )
+
     args = p.parse_args()
 
     return args
 
 
-def create_aws_session(region, profile_name):
-    global dynamodb_client, dynamodb_resource
+def create_aws_session(region, profile_name, concurrency=None):
+    global dynamodb_client, write_client
+
+    session.create_aws_session(region, profile_name)
+
+    dynamodb_client = session.client('dynamodb', concurrency)
+    write_client = session.client('dynamodb', concurrency, WRITE_RETRIES)
+
+
+def split_conjunction(expression):
+    # Terms of "a AND b AND c" at the top level of the expression; None when it has a top-level OR or NOT.
+    # Only placeholders hold values, so keywords can't appear inside string literals
+    terms = []
+    depth = 0
+    start = 0
+    between = False
+
+    for match in re.finditer(r'[()]|(?<![#:\w])(?:AND|OR|NOT|BETWEEN)(?!\w)', expression, re.IGNORECASE):
+        token = match.group(0).upper()
+
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+        elif depth:
+            continue
+        elif token in ('OR', 'NOT'):
+            return None
+        elif token == 'BETWEEN':
+            between = True
+        elif between:
+            # The AND of "BETWEEN :a AND :b"
+            between = False
+        else:
+            terms.append(expression[start:match.start()].strip())
+            start = match.end()
+
+    terms.append(expression[start:].strip())
+
+    return terms
+
+
+def key_condition_name(term, names):
+    # Attribute name a term of a filter compares in a way Query accepts as a key condition, and whether it is equality
+    operand = r'(#?\w+)'
+    value = r':\w+'
+    patterns = (
+        (rf'^{operand}\s*=\s*{value}$', True),
+        (rf'^{operand}\s*(?:<|<=|>|>=)\s*{value}$', False),
+        (rf'^{operand}\s+BETWEEN\s+{value}\s+AND\s+{value}$', False),
+        (rf'^begins_with\s*\(\s*{operand}\s*,\s*{value}\s*\)$', False),
+    )
 
-    if profile_name:
-        print(f'Using profile {profile_name}\n')
-        my_session = boto3.session.Session(
-            region_name=region,
-            profile_name=profile_name
-        )
+    for pattern, equality in patterns:
+        match = re.match(pattern, term, re.IGNORECASE)
+        if match:
+            return names.get(match.group(1), match.group(1)), equality
 
-        dynamodb_client = my_session.client('dynamodb')
-        dynamodb_resource = my_session.resource('dynamodb')
-    else:
-        print('Using default profile')
+    return None, False
 
-        dynamodb_client = boto3.client('dynamodb', region_name=region)
-        dynamodb_resource = boto3.resource('dynamodb', region_name=region)
 
+def build_read_request(table, filter_expression=None, names=None, values=None):
+    # Scan or Query parameters which read only the key attributes of records to delete.
+    # A filter comparing the partition key for equality becomes a Query key condition, together with one
+    # condition on the sort key if there is such; other terms stay a filter applied by DynamoDB
+    names = dict(names or {})
+    key_names = [key['AttributeName'] for key in table['KeySchema']]
+    key_types = {key['AttributeName']: key['KeyType'] for key in table['KeySchema']}
 
-def get_records_from_dynamodb(table_name, primary_key):
-    print('Gettings records from DynamoDB table\n')
+    params = {
+        'TableName': table['TableName'],
+        'ProjectionExpression': ', '.join(f'#key{i}' for i in range(len(key_names))),
+        'ExpressionAttributeNames': names,
+    }
+    names.update({f'#key{i}': name for i, name in enumerate(key_names)})
 
-    paginator = dynamodb_client.get_paginator('scan')
-    response_iterator = paginator.paginate(
-        TableName=table_name,
-        AttributesToGet=[
-            primary_key,
-        ],
-    )
+    if values:
+        params['ExpressionAttributeValues'] = values
+
+    if not filter_expression:
+        return {'operation': 'scan', 'params': params}
+
+    key_terms = []
+    filter_terms = []
+    for term in split_conjunction(filter_expression) or []:
+        name, equality = key_condition_name(term, names)
+        key_type = key_types.get(name)
+
+        if key_type == 'HASH' and equality and not any(t[1] == 'HASH' for t in key_terms):
+            key_terms.append((term, key_type))
+        elif key_type == 'RANGE' and not any(t[1] == 'RANGE' for t in key_terms):
+            key_terms.append((term, key_type))
+        else:
+            filter_terms.append(term)
+
+    if not any(key_type == 'HASH' for _, key_type in key_terms):
+        params['FilterExpression'] = filter_expression
+        return {'operation': 'scan', 'params': params}
+
+    params['KeyConditionExpression'] = ' AND '.join(term for term, _ in key_terms)
+    if filter_terms:
+        params['FilterExpression'] = ' AND '.join(filter_terms)
+
+    return {'operation': 'query', 'params': params}
+
+
+def parse_values(values):
+    # Plain JSON values are converted to DynamoDB attribute values, numbers are kept exact
+    from boto3.dynamodb.types import TypeSerializer
+
+    serializer = TypeSerializer()
+
+    return {name: serializer.serialize(value) for name, value in json.loads(values, parse_float=Decimal).items()}
+
+
+def read_pages(read, segment=0, total_segments=1):
+    paginator = dynamodb_client.get_paginator(read['operation'])
+
+    segment_args = {}
+    if total_segments > 1:
+        segment_args = {'Segment': segment, 'TotalSegments': total_segments}
+
+    response_iterator = paginator.paginate(**read['params'], **segment_args)
 
-    response = []
     for page in response_iterator:
-        response.extend(page['Items'])
+        yield page['Items']
+
+
+def read_segment(read, segment, total_segments):
+    response = []
+    for items in read_pages(read, segment, total_segments):
+        response.extend(items)
+
+    return response
+
+
+def get_records_from_dynamodb(read, segments=1):
+    print('Gettings records from DynamoDB table\n')
+
+    response = []
+    with ThreadPoolExecutor(segments) as executor:
+        futures = [
+            executor.submit(read_segment, read, segment, segments)
+            for segment in range(segments)
+        ]
+        for future in futures:
+            response.extend(future.result())
+
+    return response
+
+
+def describe_table(table_name):
+    return dynamodb_client.describe_table(TableName=table_name)['Table']
+
+
+def table_write_capacity(table):
+    billing_mode = table.get('BillingModeSummary', {}).get('BillingMode', 'PROVISIONED')
+
+    if billing_mode == 'PROVISIONED':
+        return table['ProvisionedThroughput']['WriteCapacityUnits']
+
+    max_units = table.get('OnDemandThroughput', {}).get('MaxWriteRequestUnits', -1)
+    if max_units > 0:
+        return max_units
+
+    return table.get('WarmThroughput', {}).get('WriteUnitsPerSecond') or ON_DEMAND_WRITE_UNITS
+
+
+class RateLimiter:
+    # Token bucket shared by all threads of a process; allows one second worth of burst
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, units):
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= min(units, self.rate):
+                    self.tokens -= units
+                    return
+
+                wait = (min(units, self.rate) - self.tokens) / self.rate
+
+            sleep(wait)
+
+    def adjust(self, units):
+        # Settle the difference between estimated and actually consumed capacity
+        with self.lock:
+            self.tokens -= units
+
+
+class CapacityStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = 0
+        self.units = 0
+        self.throttled = 0
+        self.started = monotonic()
+
+    def add(self, items, units, throttled=0):
+        with self.lock:
+            self.items += items
+            self.units += units
+            self.throttled += throttled
+
+    def report(self):
+        elapsed = max(monotonic() - self.started, 1e-9)
+        print(
+            f'\nConsumed {self.units:.1f} WCU deleting {self.items} records in {elapsed:.1f}s '
+            f'({self.units / elapsed:.1f} WCU/s, {self.items / elapsed:.1f} records/s, '
+            f'{self.throttled} throttled or unprocessed retries)'
+        )
+
+
+def backoff(attempt):
+    sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)))
+
+
+class CapacityWriter:
+    # Batch writer on the low-level client, which keeps deletion within the WCU budget when a limiter is given.
+    # Takes keys as returned by the client's scan, so no deserialization or resource layer is needed.
+    # Not thread-safe: every thread uses its own writer, while the client is shared.
+    # Keys of every batch are added to the inventory done marker, when given, once the whole batch is deleted
+    def __init__(self, table_name, limiter=None, stats=None, done=None):
+        self.table_name = table_name
+        self.limiter = limiter
+        self.stats = stats or CapacityStats()
+        self.done = done
+        self.buffer = []
 
-    # Deserialize the DynamoDB response to get rid of variable type declarations
-    deserializer = TypeDeserializer()
-    deserialized_response = []
+    def __enter__(self):
+        return self
 
-    for record in response:
-        flat_record = {k: deserializer.deserialize(v) for k, v in record.items()}
-        deserialized_response.append(flat_record)
+    def __exit__(self, *exc):
+        self.flush()
 
-    del response
+    def delete_item(self, key):
+        self.buffer.append({'DeleteRequest': {'Key': key}})
 
-    return deserialized_response
+        if len(self.buffer) >= BATCH_SIZE:
+            self.flush()
 
+    def flush(self):
+        from botocore.exceptions import ConnectionError, HTTPClientError
 
-def delete_records(data, table_name):
-    table = dynamodb_resource.Table(table_name)
+        requests, self.buffer = self.buffer, []
+        keys = [request['DeleteRequest']['Key'] for request in requests]
+        attempt = 0
 
-    with table.batch_writer() as writer:
-        for index, item in enumerate(data):
-            writer.delete_item(item)
+        while requests:
+            # Deleting an item up to 1KB costs one WCU, the real cost is settled after the call
+            if self.limiter:
+                self.limiter.acquire(len(requests))
+
+            try:
+                response = write_client.batch_write_item(
+                    RequestItems={self.table_name: requests},
+                    ReturnConsumedCapacity='TOTAL'
+                )
+            except write_client.exceptions.ClientError as e:
+                code = e.response['Error']['Code']
+                if code not in THROTTLING_ERRORS + TRANSIENT_ERRORS or attempt >= MAX_RETRIES:
+                    raise
+
+                self.stats.add(0, 0, throttled=1 if code in THROTTLING_ERRORS else 0)
+                attempt += 1
+                backoff(attempt)
+                continue
+            except (ConnectionError, HTTPClientError):
+                if attempt >= MAX_RETRIES:
+                    raise
+
+                attempt += 1
+                backoff(attempt)
+                continue
+
+            units = sum(c.get('CapacityUnits', 0) for c in response.get('ConsumedCapacity', []))
+            unprocessed = response.get('UnprocessedItems', {}).get(self.table_name, [])
+
+            if self.limiter:
+                self.limiter.adjust(units - len(requests))
+            self.stats.add(len(requests) - len(unprocessed), units, throttled=1 if unprocessed else 0)
+
+            requests = unprocessed
+            if requests:
+                if attempt >= MAX_RETRIES:
+                    raise RuntimeError(f'{len(requests)} records were left unprocessed after {MAX_RETRIES} retries')
+
+                attempt += 1
+                backoff(attempt)
+
+        if self.done and keys:
+            self.done.add(map(record_id, keys))
+
+
+def record_id(record):
+    return json.dumps(record, sort_keys=True, default=str)
+
+
+def delete_records(data, table_name, limiter=None, stats=None, done=None):
+    with CapacityWriter(table_name, limiter, stats, done) as writer:
+        for index, record in enumerate(data):
+            writer.delete_item(record)
             print(f"Finished processing item number {index}", end='\r', flush=True)
 
 
-def split_list(lst, n):
-    return [lst[i::n] for i in range(n)]
+def delete_segment(table_name, read, segment, total_segments, wcu=None):
+    # Runs in a pool process: scans only its own segment and deletes it page by page
+    limiter = RateLimiter(wcu) if wcu else None
+    stats = CapacityStats()
+    deleted = 0
+
+    with CapacityWriter(table_name, limiter, stats) as writer:
+        for records in read_pages(read, segment, total_segments):
+            for record in records:
+                writer.delete_item(record)
+
+            deleted += len(records)
+            print(f"Segment {segment}: finished processing item number {deleted}", end='\r', flush=True)
+
+    return deleted, stats.units, stats.throttled, metrics.drain()
+
+
+class Progress:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def add(self, n):
+        with self.lock:
+            self.count += n
+            print(f"Finished processing item number {self.count}", end='\r', flush=True)
+
+
+def stream_worker(writer, pages, failed, errors, progress):
+    try:
+        with writer:
+            while (records := pages.get()) is not None:
+                # Keep draining the queue after a failure so the scanner is never blocked
+                if failed.is_set():
+                    continue
+
+                for record in records:
+                    writer.delete_item(record)
+
+                progress.add(len(records))
+    except Exception as e:
+        errors.append(e)
+        failed.set()
+
+
+def put_page(pages, records, workers):
+    # Give up only when nobody is left to consume the queue
+    while any(w.is_alive() for w in workers):
+        try:
+            pages.put(records, timeout=1)
+            return True
+        except Full:
+            continue
+
+    return False
+
+
+def stream_segment(read, segment, total_segments, pages, failed, workers):
+    try:
+        for records in read_pages(read, segment, total_segments):
+            if failed.is_set() or not put_page(pages, records, workers):
+                break
+    except Exception:
+        failed.set()
+        raise
+
+
+def stream_delete_records(table_name, read, workers_num, queue_size, segments=1, limiter=None, stats=None):
+    print('Deleting records while scanning DynamoDB table\n')
+
+    pages = Queue(maxsize=queue_size)
+    failed = threading.Event()
+    errors = []
+    progress = Progress()
+
+    # Writers are not thread-safe, so every worker gets its own one
+    workers = [
+        threading.Thread(
+            target=stream_worker,
+            args=(CapacityWriter(table_name, limiter, stats), pages, failed, errors, progress),
+            daemon=True
+        )
+        for _ in range(workers_num)
+    ]
+    for w in workers:
+        w.start()
+
+    try:
+        with ThreadPoolExecutor(segments) as scanners:
+            futures = [
+                scanners.submit(stream_segment, read, segment, segments, pages, failed, workers)
+                for segment in range(segments)
+            ]
+            for future in futures:
+                future.result()
+    finally:
+        for _ in workers:
+            put_page(pages, None, workers)
+
+        for w in workers:
+            w.join()
+
+    if errors:
+        raise errors[0]
+
+    return progress.count
+
+
+def item_write_units(item_count, size_bytes):
+    # Deleting an item costs one write unit per started 1KB of its size; the average item size is used for all items
+    if not item_count:
+        return 0
+
+    return item_count * max(math.ceil(size_bytes / item_count / 1024), 1)
+
+
+def format_duration(seconds):
+    if seconds < 120:
+        return f'{seconds:.0f}s'
+    if seconds < 7200:
+        return f'{seconds / 60:.0f} min'
+
+    return f'{seconds / 3600:.1f} h'
+
+
+def plan_deletion(table, wcu=None):
+    # ItemCount and TableSizeBytes are refreshed by DynamoDB about every six hours, so the plan is an estimate
+    items = table.get('ItemCount', 0)
+    size = table.get('TableSizeBytes', 0)
+    gsis = table.get('GlobalSecondaryIndexes', [])
+    lsis = table.get('LocalSecondaryIndexes', [])
+
+    # Deleting an item also deletes its projections: local indexes consume the table write capacity,
+    # global indexes their own
+    table_units = item_write_units(items, size) + sum(
+        item_write_units(index.get('ItemCount', 0), index.get('IndexSizeBytes', 0)) for index in lsis
+    )
+    index_units = sum(item_write_units(index.get('ItemCount', 0), index.get('IndexSizeBytes', 0)) for index in gsis)
+    rate = wcu or table_write_capacity(table)
+
+    blockers = []
+    if table.get('TableStatus') != 'ACTIVE':
+        blockers.append(f'table status is {table.get("TableStatus")}')
+    if table.get('DeletionProtectionEnabled'):
+        blockers.append('deletion protection is enabled')
+    if table.get('Replicas'):
+        blockers.append('the table is a global table with replicas')
+
+    plan = {
+        'items': items,
+        'size': size,
+        # Eventually consistent scan reads 8KB per read unit
+        'scan_read_units': math.ceil(size / 8192),
+        'scan_write_units': table_units + index_units,
+        'scan_seconds': table_units / rate,
+        'scan_rate': rate,
+        'recreate_seconds': RECREATE_SECONDS + RECREATE_INDEX_SECONDS * len(gsis),
+        'blockers': blockers,
+    }
+    plan['strategy'] = 'recreate' if not blockers and plan['recreate_seconds'] < plan['scan_seconds'] else 'scan'
+
+    return plan
+
+
+def print_plan(plan):
+    print(
+        f'Table has about {plan["items"]} records, {plan["size"] / 1024 ** 2:.1f} MB '
+        '(numbers are updated by DynamoDB about every six hours)\n'
+    )
+    print(
+        f'scan:     ~{format_duration(plan["scan_seconds"])} at {plan["scan_rate"]:.0f} WCU/s, '
+        f'{plan["scan_read_units"]} read units and {plan["scan_write_units"]} write units (including indexes)'
+    )
+    print(
+        f'recreate: ~{format_duration(plan["recreate_seconds"])}, no read or write units; '
+        'the table is unavailable meanwhile and gets a new stream ARN'
+    )
+
+    if plan['blockers']:
+        print(f'\nThe table can\'t be recreated: {", ".join(plan["blockers"])}')
+
+    print(f'\nFaster strategy: {plan["strategy"]}\n')
+
+
+def get_tags(table_arn):
+    tags = []
+    args = {'ResourceArn': table_arn}
+
+    while True:
+        response = dynamodb_client.list_tags_of_resource(**args)
+        tags.extend(response.get('Tags', []))
+
+        if 'NextToken' not in response:
+            break
+        args['NextToken'] = response['NextToken']
+
+    # Tags with the aws: prefix are set by AWS services and can't be set by users
+    return [tag for tag in tags if not tag['Key'].startswith('aws:')]
+
+
+def throughput_params(description, billing_mode):
+    if billing_mode == 'PROVISIONED':
+        provisioned = description['ProvisionedThroughput']
+        return {
+            'ProvisionedThroughput': {
+                'ReadCapacityUnits': provisioned['ReadCapacityUnits'],
+                'WriteCapacityUnits': provisioned['WriteCapacityUnits']
+            }
+        }
+
+    on_demand = {k: v for k, v in description.get('OnDemandThroughput', {}).items() if v > 0}
+
+    return {'OnDemandThroughput': on_demand} if on_demand else {}
+
+
+def get_table_definition(table):
+    # CreateTable parameters of the table, and settings which can only be set once the table is created
+    table_name = table['TableName']
+    billing_mode = table.get('BillingModeSummary', {}).get('BillingMode', 'PROVISIONED')
+
+    create_table = {
+        'TableName': table_name,
+        'AttributeDefinitions': table['AttributeDefinitions'],
+        'KeySchema': table['KeySchema'],
+        'BillingMode': billing_mode,
+        **throughput_params(table, billing_mode)
+    }
+
+    if table.get('GlobalSecondaryIndexes'):
+        create_table['GlobalSecondaryIndexes'] = [
+            {
+                'IndexName': index['IndexName'],
+                'KeySchema': index['KeySchema'],
+                'Projection': index['Projection'],
+                **throughput_params(index, billing_mode)
+            }
+            for index in table['GlobalSecondaryIndexes']
+        ]
+
+    if table.get('LocalSecondaryIndexes'):
+        create_table['LocalSecondaryIndexes'] = [
+            {'IndexName': index['IndexName'], 'KeySchema': index['KeySchema'], 'Projection': index['Projection']}
+            for index in table['LocalSecondaryIndexes']
+        ]
+
+    stream = table.get('StreamSpecification', {})
+    if stream.get('StreamEnabled'):
+        create_table['StreamSpecification'] = {'StreamEnabled': True, 'StreamViewType': stream['StreamViewType']}
+
+    sse = table.get('SSEDescription', {})
+    if sse.get('SSEType') == 'KMS':
+        create_table['SSESpecification'] = {'Enabled': True, 'SSEType': 'KMS', 'KMSMasterKeyId': sse['KMSMasterKeyArn']}
+
+    table_class = table.get('TableClassSummary', {}).get('TableClass')
+    if table_class and table_class != 'STANDARD':
+        create_table['TableClass'] = table_class
+
+    tags = get_tags(table['TableArn'])
+    if tags:
+        create_table['Tags'] = tags
+
+    ttl = dynamodb_client.describe_time_to_live(TableName=table_name)['TimeToLiveDescription']
+    backups = dynamodb_client.describe_continuous_backups(TableName=table_name)['ContinuousBackupsDescription']
+    pitr = backups.get('PointInTimeRecoveryDescription', {}).get('PointInTimeRecoveryStatus')
+
+    return {
+        'CreateTable': create_table,
+        'TimeToLiveAttribute': ttl.get('AttributeName') if ttl.get('TimeToLiveStatus') in ('ENABLED', 'ENABLING') else None,
+        'PointInTimeRecovery': pitr == 'ENABLED'
+    }
+
+
+def save_table_definition(definition, filename):
+    with open(filename, 'w') as f:
+        json.dump(definition, f, indent=4, default=str)
+
+    print(f'Table definition saved to {filename}')
+
+
+def wait_for_table(table_name):
+    # The table_exists waiter doesn't wait for global secondary indexes, which are created after the table
+    deadline = monotonic() + WAIT_TIMEOUT
+
+    while True:
+        table = describe_table(table_name)
+        statuses = [table['TableStatus']] + [index['IndexStatus'] for index in table.get('GlobalSecondaryIndexes', [])]
+
+        if all(status == 'ACTIVE' for status in statuses):
+            return
+        if monotonic() > deadline:
+            raise RuntimeError(f'Table {table_name} is not active after {WAIT_TIMEOUT}s')
+
+        sleep(WAIT_DELAY)
+
+
+def recreate_table(definition):
+    table_name = definition['CreateTable']['TableName']
+
+    print(f'Deleting DynamoDB table {table_name}')
+    dynamodb_client.delete_table(TableName=table_name)
+    dynamodb_client.get_waiter('table_not_exists').wait(
+        TableName=table_name,
+        WaiterConfig={'Delay': WAIT_DELAY, 'MaxAttempts': WAIT_TIMEOUT // WAIT_DELAY}
+    )
+
+    print(f'Creating DynamoDB table {table_name}')
+    dynamodb_client.create_table(**definition['CreateTable'])
+    wait_for_table(table_name)
+
+    if definition['TimeToLiveAttribute']:
+        dynamodb_client.update_time_to_live(
+            TableName=table_name,
+            TimeToLiveSpecification={'Enabled': True, 'AttributeName': definition['TimeToLiveAttribute']}
+        )
+
+    if definition['PointInTimeRecovery']:
+        dynamodb_client.update_continuous_backups(
+            TableName=table_name,
+            PointInTimeRecoverySpecification={'PointInTimeRecoveryEnabled': True}
+        )
+
+    print(
+        '\nTable was recreated. Not restored: auto scaling policies, resource-based policy, '
+        'Kinesis streaming destinations, contributor insights, warm throughput; '
+        'the stream ARN has changed, so stream consumers have to be updated'
+    )
 
 
 def main():
     args = parse_cmd()
+    metrics.enable(args.metrics_file)
 
     region = args.region
     dynamodb_name = args.dynamodb
-    primary_key = args.primary_key
     profile_name = args.profile_name
     process_num = int(args.process_num)
+    segments = int(args.segments) if args.segments else process_num
+
+    # Scanning threads and, in stream mode, deleting threads share one client
+    create_aws_session(region, profile_name, segments + int(args.workers) if args.stream else segments)
+
+    table = describe_table(dynamodb_name)
+    key_names = [key['AttributeName'] for key in table['KeySchema']]
+
+    if args.primary_key and args.primary_key != key_names[0]:
+        print(f'The partition key of the table is {key_names[0]}, not {args.primary_key}')
+        exit(1)
 
-    create_aws_session(region, profile_name)
+    if args.inventory and (args.stream or process_num > 1):
+        print('--inventory can be used only without --stream and --process-num')
+        exit(1)
 
-    data = get_records_from_dynamodb(dynamodb_name, primary_key)
+    if args.filter and (args.strategy != 'scan' or args.dry_run):
+        print('--filter deletes only some records, so it can be used only with the scan strategy')
+        exit(1)
 
-    print(f'Got {len(data)} records from the DynamoDB table\n')
+    read = build_read_request(
+        table,
+        args.filter,
+        json.loads(args.names) if args.names else None,
+        parse_values(args.values) if args.values else None
+    )
 
-    if process_num > 1:
-        with Pool(process_num) as p:
-            data_chunks = split_list(data, process_num)
+    if read['operation'] == 'query' and segments > 1:
+        # Query reads a single partition, which can't be split into segments
+        print('Records of a single partition are read with Query, --segments and --process-num are ignored\n')
+        segments = process_num = 1
+
+    wcu = None
+    if args.wcu:
+        wcu = float(args.wcu)
+    elif args.capacity_fraction:
+        wcu = table_write_capacity(table) * float(args.capacity_fraction)
+
+    if args.dry_run or args.strategy != 'scan':
+        plan = plan_deletion(table, wcu)
+        print_plan(plan)
+
+        if args.dry_run:
+            print('Dry run, nothing was deleted')
+            return
+
+        if args.strategy == 'recreate' and plan['blockers']:
+            exit(1)
+
+        if plan['strategy'] == 'recreate' or args.strategy == 'recreate':
+            # The definition is saved first, so the table can be created manually if recreating fails halfway
+            definition = get_table_definition(table)
+            save_table_definition(definition, f'{dynamodb_name}-definition.json')
+            recreate_table(definition)
+
+            print('\nFinished')
+            return
+
+    limiter = None
+    stats = CapacityStats()
+    if wcu:
+        print(f'Limiting deletion to {wcu:.1f} WCU per second\n')
+        limiter = RateLimiter(wcu if args.stream or process_num == 1 else wcu / process_num)
+
+    if args.stream:
+        deleted = stream_delete_records(
+            dynamodb_name, read, int(args.workers), int(args.queue_size), segments, limiter, stats
+        )
 
-            p.starmap(delete_records, [(part, dynamodb_name) for part in data_chunks])
+        print(f'\nDeleted {deleted} records from the DynamoDB table')
+    elif process_num > 1:
+        # Every process scans and deletes its own segments, nothing is pickled between processes
+        with Pool(process_num, initializer=create_aws_session, initargs=(region, profile_name)) as p:
+            results = p.starmap(
+                delete_segment,
+                [
+                    (dynamodb_name, read, segment, segments, limiter and limiter.rate)
+                    for segment in range(segments)
+                ]
+            )
+
+        for deleted, units, throttled, operations in results:
+            stats.add(deleted, units, throttled)
+            metrics.merge(operations)
+
+        print(f'\nDeleted {stats.items} records from the DynamoDB table')
     else:
-        delete_records(data, dynamodb_name)
+        cache = None
+
+        if args.inventory:
+            # Listings of different filters are cached separately
+            cache = inventory.open_inventory(args.inventory, args.inventory_ttl)
+            scope = json.dumps(read, sort_keys=True, default=str)
+            data = cache.get('dynamodb-keys', lambda: get_records_from_dynamodb(read, segments), record_id, scope=scope)
+        else:
+            data = get_records_from_dynamodb(read, segments)
+
+        print(f'Got {len(data)} records from the DynamoDB table\n')
+
+        with cache.marker('dynamodb-keys', scope) if cache else nullcontext() as done:
+            delete_records(data, dynamodb_name, limiter, stats, done)
+
+    if limiter:
+        stats.report()
 
     print('\nFinished')
 
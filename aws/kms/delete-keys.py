@@ -1,6 +1,14 @@
 #!/usr/bin/env python3
-import boto3
+import os
+import sys
 import argparse
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+# Makes the shared cloud_scripts package importable when the script is run directly from the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from cloud_scripts import session, metrics, inventory  # noqa: E402
 
 
 def parse_cmd():
@@ -18,6 +26,46 @@ def parse_cmd():
         help='The name of the AWS profile which script should use'
     )
 
+    p.add_argument(
+        '--pending-window-days',
+        help='Waiting period before keys are deleted, 7-30 days (default - 7)',
+        type=int,
+        choices=range(7, 31),
+        metavar='{7-30}',
+        default=7
+    )
+
+    p.add_argument(
+        '--key-states',
+        help='Comma-separated key states which should be scheduled for deletion (default - Enabled)',
+        default='Enabled'
+    )
+
+    p.add_argument(
+        '--workers',
+        help='Describe and schedule keys concurrently with this number of workers (default - serial)',
+        default=None
+    )
+
+    p.add_argument(
+        '--inventory',
+        help='Cache the listed keys in this SQLite file, so a rerun within --inventory-ttl skips listing '
+             'and continues with keys which are not processed yet'
+    )
+
+    p.add_argument(
+        '--inventory-ttl',
+        help='Seconds after which cached listings are listed again (default - 900)',
+        type=int,
+        default=900
+    )
+
+    p.add_argument(
+        '--metrics-file',
+        help='Save per-operation API call metrics to this file at exit: '
+             '".prom" - Prometheus text format, any other extension - JSON'
+    )
+
     args = p.parse_args()
 
     return args
@@ -26,16 +74,9 @@ def parse_cmd():
 def create_aws_session(region, profile_name):
     global kms
 
-    if profile_name:
-        print(f'Using profile {profile_name}\n')
-        my_session = boto3.session.Session(
-            region_name=region,
-            profile_name=profile_name
-        )
-        kms = my_session.client('kms')
-    else:
-        print('Using default profile')
-        kms = boto3.client('kms', region_name=region)
+    session.create_aws_session(region, profile_name)
+
+    kms = session.client('kms')
 
 
 def get_keys():
@@ -50,25 +91,77 @@ def get_keys():
     return keys
 
 
-def delete_keys(keys):
-    for key in keys:
-        key_desc = kms.describe_key(
-            KeyId=key['KeyId']
+def get_aws_managed_key_ids(client):
+    # AWS managed keys are the targets of "alias/aws/*" aliases, so they can be skipped without describing them
+    paginator = client.get_paginator('list_aliases')
+    key_ids = set()
+
+    for page in paginator.paginate():
+        for alias in page['Aliases']:
+            if alias['AliasName'].startswith('alias/aws/') and 'TargetKeyId' in alias:
+                key_ids.add(alias['TargetKeyId'])
+
+    return key_ids
+
+
+def delete_key(client, key_id, pending_window_days=7, key_states=('Enabled',)):
+    key_desc = client.describe_key(
+        KeyId=key_id
+    )
+
+    if key_desc['KeyMetadata']['KeyManager'] == 'CUSTOMER' and key_desc['KeyMetadata']['KeyState'] in key_states:
+        print(f"Scheduling deletion for key {key_desc['KeyMetadata']['Arn']}")
+
+        client.schedule_key_deletion(
+            KeyId=key_desc['KeyMetadata']['KeyId'],
+            PendingWindowInDays=pending_window_days
         )
 
-        if key_desc['KeyMetadata']['KeyManager'] == 'CUSTOMER' and key_desc['KeyMetadata']['KeyState'] == 'Enabled':
-            print(f"Scheduling deletion for key {key_desc['Arn']}")
+        return True
+
+    return False
+
 
-            kms.schedule_key_deletion(
-                KeyId=key_desc['KeyMetadata']['KeyId'],
-                PendingWindowInDays=7
-            )
+def delete_keys(keys, pending_window_days=7, key_states=('Enabled',), cache=None):
+    with cache.marker('kms-keys') if cache else nullcontext() as done:
+        for key in keys:
+            delete_key(kms, key['KeyId'], pending_window_days, key_states)
+
+            if done:
+                done.add([key['KeyId']])
 
     return
 
 
+def concurrent_delete_keys(keys, workers_num, pending_window_days=7, key_states=('Enabled',), cache=None):
+    client = session.client('kms', workers_num)
+
+    aws_managed = get_aws_managed_key_ids(client)
+    key_ids = [key['KeyId'] for key in keys if key['KeyId'] not in aws_managed]
+    print(f'Skipping {len(keys) - len(key_ids)} AWS managed keys, checking {len(key_ids)} keys\n')
+
+    with cache.marker('kms-keys') if cache else nullcontext() as done:
+        if done:
+            done.add(aws_managed)
+
+        def delete(key_id):
+            scheduled = delete_key(client, key_id, pending_window_days, key_states)
+
+            if done:
+                done.add([key_id])
+
+            return scheduled
+
+        # Every worker describes a key and schedules its deletion right away, so calls for different keys overlap
+        with ThreadPoolExecutor(workers_num) as executor:
+            scheduled = executor.map(delete, key_ids)
+
+            print(f'Scheduled deletion for {sum(scheduled)} keys')
+
+
 def main():
     args = parse_cmd()
+    metrics.enable(args.metrics_file)
 
     region = args.region
     profile_name = args.profile_name
@@ -76,11 +169,19 @@ def main():
     create_aws_session(region, profile_name)
 
     try:
-        keys = get_keys()
-        delete_keys(keys)
+        cache = inventory.open_inventory(args.inventory, args.inventory_ttl) if args.inventory else None
+        # Keys which were scheduled for deletion or skipped are marked done, so a rerun continues with the rest
+        keys = cache.get('kms-keys', get_keys, lambda key: key['KeyId']) if cache else get_keys()
+        key_states = tuple(state.strip() for state in args.key_states.split(','))
+
+        if args.workers:
+            concurrent_delete_keys(keys, int(args.workers), args.pending_window_days, key_states, cache)
+        else:
+            delete_keys(keys, args.pending_window_days, key_states, cache)
         print('Succesfully deleted all keys')
     except Exception as e:
         print(f'Smth went wrong. Error: \n{e}')
+        sys.exit(1)
 
 
 if __name__ == '__main__':
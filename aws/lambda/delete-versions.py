@@ -1,7 +1,15 @@
 #!/usr/bin/env python3
+import os
+import sys
 import argparse
+from time import monotonic
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import boto3
+# Makes the shared cloud_scripts package importable when the script is run directly from the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from cloud_scripts import session, metrics, inventory  # noqa: E402
 
 
 def parse_cmd():
@@ -19,6 +27,32 @@ def parse_cmd():
         help='The name of the AWS profile which script should use'
     )
 
+    p.add_argument(
+        '--workers',
+        help='List and delete versions of every function concurrently with this number of workers; '
+             'versions referenced by aliases or provisioned concurrency are kept (default - serial deletion)',
+        default=None
+    )
+
+    p.add_argument(
+        '--inventory',
+        help='Cache the listed function versions in this SQLite file, so a rerun within --inventory-ttl skips listing '
+             'and continues with versions which are not processed yet'
+    )
+
+    p.add_argument(
+        '--inventory-ttl',
+        help='Seconds after which cached listings are listed again (default - 900)',
+        type=int,
+        default=900
+    )
+
+    p.add_argument(
+        '--metrics-file',
+        help='Save per-operation API call metrics to this file at exit: '
+             '".prom" - Prometheus text format, any other extension - JSON'
+    )
+
     args = p.parse_args()
 
     return args
@@ -27,16 +61,9 @@ def parse_cmd():
 def create_aws_session(region, profile_name):
     global aws_lambda
 
-    if profile_name:
-        print(f'Using profile {profile_name}\n')
-        my_session = boto3.session.Session(
-            region_name=region,
-            profile_name=profile_name
-        )
-        aws_lambda = my_session.client('lambda')
-    else:
-        print('Using default profile')
-        aws_lambda = boto3.client('lambda', region_name=region)
+    session.create_aws_session(region, profile_name)
+
+    aws_lambda = session.client('lambda')
 
 
 def get_lambdas_versions():
@@ -53,26 +80,141 @@ def get_lambdas_versions():
 
     for func in func_list:
         if func['Version'] != '$LATEST':
-            versions_to_delete.append(func['FunctionArn'])
+            versions_to_delete.append((func['FunctionArn'], func.get('LastModified')))
 
     return versions_to_delete
 
 
-def delete_versions(lambdas_to_delete_list):
-    for arn in lambdas_to_delete_list:
-        print(f"Deleting function version {arn}")
+def delete_versions(lambdas_to_delete_list, cache=None):
+    with cache.marker('lambda-versions') if cache else nullcontext() as done:
+        for arn, _ in lambdas_to_delete_list:
+            print(f"Deleting function version {arn}")
 
-        aws_lambda.delete_function(
-            FunctionName=arn,
-        )
+            aws_lambda.delete_function(
+                FunctionName=arn,
+            )
 
-        print('done')
+            if done:
+                done.add([arn])
+
+            print('done')
 
     return
 
 
+def get_function_names(client):
+    paginator = client.get_paginator('list_functions')
+    names = []
+
+    for page in paginator.paginate():
+        names.extend(func['FunctionName'] for func in page['Functions'])
+
+    return names
+
+
+def get_protected_versions(client, function_name):
+    # Versions which are still in use: targets of aliases (including weighted routing)
+    # and versions with provisioned concurrency
+    protected = set()
+    alias_versions = {}
+
+    for page in client.get_paginator('list_aliases').paginate(FunctionName=function_name):
+        for alias in page['Aliases']:
+            alias_versions[alias['Name']] = alias['FunctionVersion']
+            protected.add(alias['FunctionVersion'])
+            protected.update(alias.get('RoutingConfig', {}).get('AdditionalVersionWeights', {}))
+
+    for page in client.get_paginator('list_provisioned_concurrency_configs').paginate(FunctionName=function_name):
+        for config in page['ProvisionedConcurrencyConfigs']:
+            qualifier = config['FunctionArn'].rsplit(':', 1)[-1]
+            protected.add(alias_versions.get(qualifier, qualifier))
+
+    return protected
+
+
+def get_function_versions(client, function_name):
+    protected = get_protected_versions(client, function_name)
+    versions = []
+
+    for page in client.get_paginator('list_versions_by_function').paginate(FunctionName=function_name):
+        for version in page['Versions']:
+            if version['Version'] == '$LATEST':
+                continue
+
+            if version['Version'] in protected:
+                print(f"Keeping function version {version['FunctionArn']}, it is in use")
+                continue
+
+            versions.append((version['FunctionArn'], version.get('CodeSize', 0), version.get('LastModified')))
+
+    return versions
+
+
+def delete_version(client, arn, code_size):
+    client.delete_function(
+        FunctionName=arn,
+    )
+
+    return code_size
+
+
+def iter_function_versions(executor, client):
+    listings = [
+        executor.submit(get_function_versions, client, name)
+        for name in get_function_names(client)
+    ]
+
+    for listing in as_completed(listings):
+        yield from listing.result()
+
+
+def concurrent_delete_versions(workers_num, cache=None):
+    # Listing and deletion run on their own workers, each of them with a connection
+    client = session.client('lambda', workers_num * 2)
+    started = monotonic()
+    deleted = failed = reclaimed = 0
+
+    with cache.marker('lambda-unused-versions') if cache else nullcontext() as done:
+        with ThreadPoolExecutor(workers_num) as list_executor, ThreadPoolExecutor(workers_num) as delete_executor:
+            # Versions of a function are deleted as soon as its listing completes, while other functions are still
+            # listed. With the inventory cache all versions are listed first, so only a complete listing is cached
+            versions = iter_function_versions(list_executor, client)
+            if cache:
+                versions = cache.get(
+                    'lambda-unused-versions',
+                    lambda: list(versions),
+                    lambda version: version[0],
+                    lambda version: version[2]
+                )
+
+            deletions = {}
+            for arn, code_size, _ in versions:
+                deletions[delete_executor.submit(delete_version, client, arn, code_size)] = arn
+
+            for deletion in as_completed(deletions):
+                try:
+                    reclaimed += deletion.result()
+                    deleted += 1
+
+                    if done:
+                        done.add([deletions[deletion]])
+                except Exception as e:
+                    failed += 1
+                    print(f'Failed to delete function version {deletions[deletion]}. Error: {e}')
+
+    elapsed = max(monotonic() - started, 1e-9)
+    print(
+        f'Deleted {deleted} versions in {elapsed:.1f}s ({deleted / elapsed:.1f} versions/s), '
+        f'reclaimed {reclaimed / 1024 ** 2:.1f} MiB of code storage'
+    )
+
+    if failed:
+        raise RuntimeError(f'Failed to delete {failed} versions')
+
+
 def main():
     args = parse_cmd()
+    metrics.enable(args.metrics_file)
 
     region = args.region
     profile_name = args.profile_name
@@ -80,11 +222,26 @@ def main():
     create_aws_session(region, profile_name)
 
     try:
-        arns_to_delete = get_lambdas_versions()
-        delete_versions(arns_to_delete)
+        cache = inventory.open_inventory(args.inventory, args.inventory_ttl) if args.inventory else None
+
+        if args.workers:
+            concurrent_delete_versions(int(args.workers), cache)
+        else:
+            if cache:
+                # Versions listed again with the same LastModified stay done when the cached listing expires
+                arns_to_delete = cache.get(
+                    'lambda-versions',
+                    get_lambdas_versions,
+                    lambda version: version[0],
+                    lambda version: version[1]
+                )
+            else:
+                arns_to_delete = get_lambdas_versions()
+            delete_versions(arns_to_delete, cache)
         print('Successfully deleted all lambda versions except for LATEST')
     except Exception as e:
         print(f'Smth went wrong. Error text:\n{e}')
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -1,15 +1,25 @@
 import os
+import sys
 import json
 import os.path
 import argparse
+import random
+import threading
+from time import sleep
+from queue import Queue
 
-import boto3
+# Makes the shared cloud_scripts package importable when the script is run directly from the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
 
+from cloud_scripts import session, metrics, sink, decode  # noqa: E402
 
-# TODO:
-# * Add option to delete retrieved messages from the queue
 
-curr_dir = os.path.dirname(os.path.abspath(__file__))
+# DeleteMessageBatch accepts up to 10 entries per call
+DELETE_BATCH_SIZE = 10
+# Entries which DeleteMessageBatch failed to delete are retried this number of times with backoff
+DELETE_RETRIES = 5
+BACKOFF_BASE = 0.2
+BACKOFF_CAP = 10
 
 
 def parse_cmd():
@@ -41,6 +51,84 @@ def parse_cmd():
         required=True
     )
 
+    p.add_argument(
+        '--receivers',
+        help='Drain the queue with this number of concurrent long-polling receivers, '
+             'writing one message per line as they arrive (default - single receiver, JSON array '
+             'or, with --compression, --max-part-* or --decode, one message per line)',
+        default=None
+    )
+
+    p.add_argument(
+        '--wait-time',
+        help='Long polling wait time in seconds for drain mode (default - 20)',
+        default=20
+    )
+
+    p.add_argument(
+        '--empty-polls',
+        help='Drain mode stops after every receiver got this number of empty or already extracted responses '
+             'in a row and the queue reports no messages left to extract (default - 3)',
+        default=3
+    )
+
+    p.add_argument(
+        '--visibility-timeout',
+        help='Seconds received messages stay hidden from other receivers, overrides the visibility timeout of '
+             'the queue; without --delete it should be longer than the extraction (default - 900)',
+        default=900
+    )
+
+    p.add_argument(
+        '--delete',
+        help='Drain mode only: delete messages from the queue once they are flushed and fsynced to the file',
+        action='store_true'
+    )
+
+    p.add_argument(
+        '--compression',
+        help='Compress the output with this codec; zstd requires Python 3.14 or the zstandard package '
+             '(default - no compression)',
+        choices=['gzip', 'zstd']
+    )
+
+    p.add_argument(
+        '--max-part-bytes',
+        help='Split the output into numbered parts of about this size in bytes (after compression), '
+             'listed in a .manifest.json file next to them'
+    )
+
+    p.add_argument(
+        '--max-part-records',
+        help='Split the output into numbered parts of at most this number of messages, '
+             'listed in a .manifest.json file next to them'
+    )
+
+    p.add_argument(
+        '--decode',
+        help='Write decoded messages: SNS envelopes unwrapped, base64/gzip bodies decoded, JSON bodies parsed '
+             'and message attributes flattened, one message per line. Decoding runs on a process pool',
+        action='store_true'
+    )
+
+    p.add_argument(
+        '--decode-workers',
+        help='Number of processes decoding messages (default - number of CPUs)',
+        default=None
+    )
+
+    p.add_argument(
+        '--decode-chunk-size',
+        help='Number of messages a decoding process takes at a time (default - 500)',
+        default=500
+    )
+
+    p.add_argument(
+        '--metrics-file',
+        help='Save per-operation API call metrics to this file at exit: '
+             '".prom" - Prometheus text format, any other extension - JSON'
+    )
+
     args = p.parse_args()
 
     return args
@@ -49,18 +137,9 @@ def parse_cmd():
 def create_aws_session(region, profile_name):
     global sqs
 
-    if profile_name:
-        print(f'Using profile {profile_name}\n')
-        my_session = boto3.session.Session(
-            region_name=region,
-            profile_name=profile_name
-        )
-
-        sqs = my_session.client('sqs')
-    else:
-        print('Using default profile')
+    session.create_aws_session(region, profile_name)
 
-        sqs = boto3.client('sqs', region_name=region)
+    sqs = session.client('sqs')
 
 
 def save_data_to_json(data, filename):
@@ -68,34 +147,343 @@ def save_data_to_json(data, filename):
         json.dump(data, file, indent=4, sort_keys=True, default=str)
 
 
-def extract_messages(sqs_url, filename):
+def extract_messages(sqs_url, filename, visibility_timeout, output=None, decoder=None):
+    # With an output sink messages are written as they are received instead of a JSON array at the end.
+    # With a decoder chunks of messages are decoded while the next ones are received
     messages = []
+    chunk = []
 
     while True:
         response = sqs.receive_message(
             QueueUrl=sqs_url,
             AttributeNames=['All'],
-            MaxNumberOfMessages=10
+            MessageAttributeNames=['All'],
+            MaxNumberOfMessages=10,
+            VisibilityTimeout=visibility_timeout
         )
         try:
-            messages.extend(response['Messages'])
+            if decoder:
+                chunk.extend(response['Messages'])
+            elif output:
+                output.write(response['Messages'])
+            else:
+                messages.extend(response['Messages'])
         except KeyError:
             break
-    
-    save_data_to_json(messages, filename)
+
+        if decoder and len(chunk) >= decoder.chunk_size:
+            decoder.submit(chunk)
+            chunk = []
+
+        if decoder:
+            for decoded, _ in decoder.completed():
+                output.write(decoded)
+
+    if decoder:
+        if chunk:
+            decoder.submit(chunk)
+        for decoded, _ in decoder.completed(wait=True):
+            output.write(decoded)
+
+    if output:
+        output.close()
+    else:
+        save_data_to_json(messages, filename)
+
+
+def queue_is_drained(sqs_url, extracted, delete):
+    attributes = sqs.get_queue_attributes(
+        QueueUrl=sqs_url,
+        AttributeNames=[
+            'ApproximateNumberOfMessages',
+            'ApproximateNumberOfMessagesNotVisible',
+            'ApproximateNumberOfMessagesDelayed'
+        ]
+    )['Attributes']
+    counts = {name: int(value) for name, value in attributes.items()}
+
+    if delete:
+        return counts['ApproximateNumberOfMessages'] == 0 and counts['ApproximateNumberOfMessagesDelayed'] == 0
+
+    # Messages which are not deleted stay in the queue and become visible again once their visibility timeout
+    # expires, so the queue is drained when it holds no more messages than were extracted
+    return sum(counts.values()) <= extracted
+
+
+def receive_worker(client, sqs_url, wait_time, visibility_timeout, batches, streaks, index, seen, lock, stop,
+                   errors):
+    # Messages can be received more than once while they are not deleted, only the first copy is passed on
+    # to be written, but receipts (message ID and receipt handle) of all copies are, so that duplicates are deleted too
+    try:
+        while not stop.is_set():
+            response = client.receive_message(
+                QueueUrl=sqs_url,
+                AttributeNames=['All'],
+                MessageAttributeNames=['All'],
+                MaxNumberOfMessages=10,
+                WaitTimeSeconds=wait_time,
+                VisibilityTimeout=visibility_timeout
+            )
+            messages = response.get('Messages', [])
+
+            with lock:
+                unique = [m for m in messages if m['MessageId'] not in seen]
+                seen.update(m['MessageId'] for m in unique)
+
+            # A response with only extracted messages counts as empty, otherwise messages which come back after
+            # their visibility timeout would keep the drain going forever
+            if unique:
+                streaks[index] = 0
+            else:
+                streaks[index] += 1
+
+            if messages:
+                batches.put((unique, [(m['MessageId'], m['ReceiptHandle']) for m in messages]))
+    except Exception as e:
+        errors.append(e)
+        stop.set()
+
+
+def take_batches(batches):
+    # Blocks for one batch, then takes all the others which are already waiting; None marks the end
+    group = [batches.get()]
+
+    while group[-1] is not None and not batches.empty():
+        group.append(batches.get())
+
+    return group
+
+
+def write_messages(output, messages, receipts, stats, acks):
+    output.write(messages)
+
+    # Messages are acknowledged only when they are durably on disk, duplicates included
+    if acks is not None and receipts:
+        output.sync()
+
+        for i in range(0, len(receipts), DELETE_BATCH_SIZE):
+            acks.put(receipts[i:i + DELETE_BATCH_SIZE])
+
+    stats['written'] += len(messages)
+    print(f"Written {stats['written']} messages", end='\r', flush=True)
+
+
+def write_worker(batches, output, stats, stop, errors, acks=None, decoder=None):
+    # Encoding, compression and writing run on the output's own thread, decoding on the decoder's processes;
+    # messages wait for a full chunk only while more batches are coming in
+    finished = False
+    chunk = []
+    chunk_receipts = []
+
+    try:
+        with output:
+            while not finished:
+                group = take_batches(batches)
+                finished = group[-1] is None
+                unique = [m for batch in group if batch for m in batch[0]]
+                receipts = [receipt for batch in group if batch for receipt in batch[1]]
+                stats['duplicates'] += len(receipts) - len(unique)
+
+                if decoder is None:
+                    write_messages(output, unique, receipts, stats, acks)
+                    continue
+
+                chunk.extend(unique)
+                chunk_receipts.extend(receipts)
+
+                if chunk_receipts and (len(chunk) >= decoder.chunk_size or finished or batches.empty()):
+                    decoder.submit(chunk, chunk_receipts)
+                    chunk = []
+                    chunk_receipts = []
+
+                for decoded, decoded_receipts in decoder.completed(wait=finished):
+                    write_messages(output, decoded, decoded_receipts, stats, acks)
+    except Exception as e:
+        errors.append(e)
+        stop.set()
+
+        # Keep receivers from blocking on a full queue until they notice the stop
+        while not finished and batches.get() is not None:
+            pass
+
+
+def backoff(attempt):
+    sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)))
+
+
+def delete_batch(client, sqs_url, receipts):
+    # Deletes messages by their receipts, retrying failed entries; returns the number of deleted messages
+    # and IDs of messages left in the queue. Sender faults, f.e. an expired receipt handle, are not retried,
+    # as they fail the same way every time
+    pending = {str(i): receipt for i, receipt in enumerate(receipts)}
+    deleted = 0
+    left = []
+
+    for attempt in range(DELETE_RETRIES + 1):
+        if attempt:
+            backoff(attempt)
+
+        response = client.delete_message_batch(
+            QueueUrl=sqs_url,
+            Entries=[{'Id': entry_id, 'ReceiptHandle': handle} for entry_id, (_, handle) in pending.items()]
+        )
+        deleted += len(response.get('Successful', []))
+
+        failed = response.get('Failed', [])
+        left.extend(pending[entry['Id']][0] for entry in failed if entry.get('SenderFault'))
+        pending = {entry['Id']: pending[entry['Id']] for entry in failed if not entry.get('SenderFault')}
+
+        if not pending:
+            break
+
+    return deleted, left + [message_id for message_id, _ in pending.values()]
+
+
+def delete_worker(client, sqs_url, acks, results, stop, errors):
+    deleted = 0
+    failed = []
+
+    try:
+        while (receipts := acks.get()) is not None:
+            batch_deleted, batch_failed = delete_batch(client, sqs_url, receipts)
+
+            deleted += batch_deleted
+            failed.extend(batch_failed)
+    except Exception as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        results.append((deleted, failed))
+
+
+def save_undeleted(filename, message_ids):
+    # IDs of messages which are written to the file, but still in the queue
+    undeleted_file = os.path.splitext(filename)[0] + '.undeleted.txt'
+
+    with open(undeleted_file, 'w') as file:
+        file.writelines(message_id + '\n' for message_id in message_ids)
+
+    return undeleted_file
+
+
+def drain_messages(sqs_url, output, receivers_num, wait_time, visibility_timeout, empty_polls, delete=False,
+                   decoder=None):
+    batches = Queue(maxsize=receivers_num * 10)
+    streaks = [0] * receivers_num
+    seen = set()
+    seen_lock = threading.Lock()
+    stop = threading.Event()
+    errors = []
+    stats = {'written': 0, 'duplicates': 0}
+
+    # Deletion keeps pace with receiving, so there is one deleter per receiver
+    acks = Queue() if delete else None
+    deleters_num = receivers_num if delete else 0
+    delete_results = []
+
+    # Every receiver keeps a long poll open, so the connection pool must fit all of them
+    client = session.client('sqs', receivers_num + deleters_num)
+
+    writer = threading.Thread(target=write_worker, args=(batches, output, stats, stop, errors, acks, decoder))
+    writer.start()
+
+    deleters = [
+        threading.Thread(target=delete_worker, args=(client, sqs_url, acks, delete_results, stop, errors))
+        for _ in range(deleters_num)
+    ]
+    for d in deleters:
+        d.start()
+
+    receivers = [
+        threading.Thread(
+            target=receive_worker,
+            args=(
+                client, sqs_url, wait_time, visibility_timeout, batches, streaks, index, seen, seen_lock, stop,
+                errors
+            )
+        )
+        for index in range(receivers_num)
+    ]
+    for r in receivers:
+        r.start()
+
+    try:
+        # An empty response alone does not mean the queue is drained, messages may sit on other servers
+        while not stop.is_set():
+            sleep(1)
+
+            if all(streak >= empty_polls for streak in streaks) and queue_is_drained(sqs_url, len(seen), delete):
+                stop.set()
+    finally:
+        stop.set()
+
+        for r in receivers:
+            r.join()
+
+        batches.put(None)
+        writer.join()
+
+        for d in deleters:
+            acks.put(None)
+        for d in deleters:
+            d.join()
+
+    # Saved before errors are raised, these messages are on disk either way
+    failed = [message_id for result in delete_results for message_id in result[1]]
+    if failed:
+        print(f'\nIDs of messages left in the queue are saved to {save_undeleted(output.filename, failed)}')
+
+    if errors:
+        raise errors[0]
+
+    print(f"\nExtracted {stats['written']} messages, skipped {stats['duplicates']} duplicates")
+
+    if delete:
+        deleted = sum(result[0] for result in delete_results)
+        print(f'Deleted {deleted} messages from the queue, failed to delete {len(failed)}')
 
 
 def main():
     args = parse_cmd()
+    metrics.enable(args.metrics_file)
 
     region = args.region
     sqs_url = args.url
-    filename = curr_dir + '/' + args.file
+    # Relative to the working directory, the script itself may be installed in site-packages
+    filename = os.path.abspath(args.file)
     profile_name = args.profile_name
 
+    if args.delete and not args.receivers:
+        print('Messages can be deleted only in drain mode (--receivers)')
+        return
+
+    if args.compression == 'zstd' and not sink.zstd_available():
+        print('zstd compression requires Python 3.14 or the zstandard package: pip install "cloud-scripts[zstd]"')
+        return
+
     create_aws_session(region, profile_name)
-    
-    extract_messages(sqs_url, filename)
+
+    max_bytes = int(args.max_part_bytes) if args.max_part_bytes else None
+    max_records = int(args.max_part_records) if args.max_part_records else None
+    streamed = args.receivers or args.compression or max_bytes or max_records or args.decode
+    output = sink.JsonLinesSink(filename, args.compression, max_bytes, max_records) if streamed else None
+
+    decoder = None
+    if args.decode:
+        workers = int(args.decode_workers) if args.decode_workers else None
+        decoder = decode.Decoder(workers, int(args.decode_chunk_size))
+
+    try:
+        if args.receivers:
+            drain_messages(
+                sqs_url, output, int(args.receivers), int(args.wait_time), int(args.visibility_timeout),
+                int(args.empty_polls), args.delete, decoder
+            )
+        else:
+            extract_messages(sqs_url, filename, int(args.visibility_timeout), output, decoder)
+    finally:
+        if decoder:
+            decoder.close()
 
 
 if __name__ == "__main__":
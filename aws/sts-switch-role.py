@@ -1,7 +1,24 @@
+import os
 import sys
 import json
 import argparse
+import tempfile
 import subprocess
+from time import sleep
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+
+# Makes the shared cloud_scripts package importable when the script is run directly from the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.aws', 'sts-switch-role', 'cache')
+# Cached credentials are not reused when they expire sooner than this number of seconds
+REFRESH_MARGIN = 300
+# Helper process (--serve) refreshes credentials this number of seconds before they expire,
+# well ahead of REFRESH_MARGIN, so credential_process calls are always served from the cache
+SERVE_REFRESH_AHEAD = 900
+SERVE_RETRY_INTERVAL = 60
 
 
 def parse_cmd():
@@ -36,6 +53,40 @@ def parse_cmd():
         default='temporary'
     )
 
+    p.add_argument(
+        '--use-cli',
+        help='Assume role and save credentials with AWS CLI subprocesses instead of boto3',
+        action='store_true'
+    )
+
+    p.add_argument(
+        '--no-cache',
+        help='Always assume role, even if cached credentials are still valid',
+        action='store_true'
+    )
+
+    p.add_argument(
+        '-d',
+        '--duration-seconds',
+        help='Lifetime of the temporary credentials in seconds (default - 3600)',
+        type=int,
+        default=3600
+    )
+
+    mode = p.add_mutually_exclusive_group()
+
+    mode.add_argument(
+        '--credential-process',
+        help='Print credentials in AWS credential_process format instead of saving them to the target profile',
+        action='store_true'
+    )
+
+    mode.add_argument(
+        '--serve',
+        help='Keep running and refresh cached credentials and the target profile in the background before they expire',
+        action='store_true'
+    )
+
     args = p.parse_args()
 
     return args
@@ -49,23 +100,142 @@ def run_command(command):
 
         return response
     except subprocess.CalledProcessError as e:
-        print('-'*60)
-        print(f'Something went wrong. Subprocess error:\n{e}')
-        print('-'*60)
+        # Errors go to stderr and the exit code is non-zero, so that an SDK calling the script
+        # as credential_process reports the failure instead of reading empty credentials
+        print('-'*60, file=sys.stderr)
+        print(f'Something went wrong. Subprocess error:\n{e}', file=sys.stderr)
+        print('-'*60, file=sys.stderr)
 
-        sys.exit()
+        sys.exit(1)
 
 
-def assume_role(account_id, role_name, source_profile, target_profile):
+def assume_role(account_id, role_name, source_profile, target_profile, duration=3600):
     response = run_command(
         f"aws sts assume-role --role-arn arn:aws:iam::{account_id}:role/{role_name}" +
-        f" --role-session-name {target_profile} --external-id {account_id} --duration-seconds 3600 --profile {source_profile}"
+        f" --role-session-name {target_profile} --external-id {account_id} --duration-seconds {duration} --profile {source_profile}"
     )
     credentials = json.loads(response.stdout.decode('utf-8'))
 
     return credentials
 
 
+def assume_role_sdk(account_id, role_name, source_profile, target_profile, duration=3600):
+    # boto3 is imported only here, so the script still works without it when --use-cli is given
+    import boto3
+    from cloud_scripts.session import client_config
+
+    session = boto3.session.Session(profile_name=source_profile)
+    response = session.client('sts', config=client_config()).assume_role(
+        RoleArn=f'arn:aws:iam::{account_id}:role/{role_name}',
+        RoleSessionName=target_profile,
+        ExternalId=account_id,
+        DurationSeconds=duration
+    )
+
+    credentials = response['Credentials']
+    credentials['Expiration'] = credentials['Expiration'].isoformat()
+
+    return {'Credentials': credentials}
+
+
+def get_cache_file(account_id, role_name, source_profile):
+    return os.path.join(CACHE_DIR, f'{source_profile}_{account_id}_{role_name}.json')
+
+
+def seconds_to_expiry(credentials):
+    expiration = datetime.fromisoformat(credentials['Credentials']['Expiration'])
+
+    return (expiration - datetime.now(timezone.utc)).total_seconds()
+
+
+def load_cached_credentials(cache_file, margin=REFRESH_MARGIN):
+    try:
+        with open(cache_file) as file:
+            credentials = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    if seconds_to_expiry(credentials) < margin:
+        return None
+
+    return credentials
+
+
+def write_private_file(filename, content):
+    # Temporary file in the same directory is renamed over the target, so readers never see a partial file
+    directory = os.path.dirname(filename)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    fd, tmp_name = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as file:
+            file.write(content)
+
+        os.replace(tmp_name, filename)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+
+
+def save_cached_credentials(credentials, cache_file):
+    write_private_file(cache_file, json.dumps(credentials))
+
+
+def update_ini_section(text, section, values):
+    # Sets keys of one section and keeps the rest of the file, comments included, as it is
+    lines = text.splitlines()
+    values = dict(values)
+    start = end = None
+
+    for i, line in enumerate(lines):
+        if line.strip().startswith('['):
+            if start is not None:
+                end = i
+                break
+            if line.strip() == f'[{section}]':
+                start = i
+
+    if start is None:
+        if lines and lines[-1].strip():
+            lines.append('')
+        lines.append(f'[{section}]')
+        start, end = len(lines) - 1, len(lines)
+    elif end is None:
+        end = len(lines)
+
+    for i in range(start + 1, end):
+        key = lines[i].split('=', 1)[0].strip()
+        if '=' in lines[i] and key in values:
+            lines[i] = f'{key} = {values.pop(key)}'
+
+    # Missing keys go right after the last non-empty line of the section
+    while end > start + 1 and not lines[end - 1].strip():
+        end -= 1
+    lines[end:end] = [f'{key} = {value}' for key, value in values.items()]
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_profile(credentials, target_profile):
+    # Single atomic write of the credentials file instead of one "aws configure set" per key
+    credentials_file = os.environ.get(
+        'AWS_SHARED_CREDENTIALS_FILE',
+        os.path.join(os.path.expanduser('~'), '.aws', 'credentials')
+    )
+
+    try:
+        with open(credentials_file) as file:
+            text = file.read()
+    except FileNotFoundError:
+        text = ''
+
+    write_private_file(credentials_file, update_ini_section(text, target_profile, {
+        'aws_access_key_id': credentials['Credentials']['AccessKeyId'],
+        'aws_secret_access_key': credentials['Credentials']['SecretAccessKey'],
+        'aws_session_token': credentials['Credentials']['SessionToken'],
+    }))
+
+
 def set_profile(credentials, target_profile):
     run_command(
         f"aws configure set profile.{target_profile}.aws_access_key_id '{credentials['Credentials']['AccessKeyId']}'")
@@ -77,8 +247,64 @@ def set_profile(credentials, target_profile):
     return
 
 
+def get_credentials(args, no_cache=False, margin=REFRESH_MARGIN):
+    cache_file = get_cache_file(args.account_id, args.role, args.source_profile)
+    credentials = None if no_cache else load_cached_credentials(cache_file, margin)
+
+    if credentials:
+        print(f"Using cached credentials, valid until {credentials['Credentials']['Expiration']}")
+
+        return credentials
+
+    role_args = (args.account_id, args.role, args.source_profile, args.target_profile, args.duration_seconds)
+    try:
+        credentials = assume_role_sdk(*role_args)
+    except ImportError:
+        print('boto3 is not installed, falling back to AWS CLI')
+        credentials = assume_role(*role_args)
+
+    save_cached_credentials(credentials, cache_file)
+
+    return credentials
+
+
+def format_credential_process(credentials):
+    return json.dumps({
+        'Version': 1,
+        'AccessKeyId': credentials['Credentials']['AccessKeyId'],
+        'SecretAccessKey': credentials['Credentials']['SecretAccessKey'],
+        'SessionToken': credentials['Credentials']['SessionToken'],
+        'Expiration': credentials['Credentials']['Expiration'],
+    })
+
+
+def serve(args):
+    print(f'Refreshing credentials for profile {args.target_profile} {SERVE_REFRESH_AHEAD}s before they expire')
+
+    while True:
+        try:
+            credentials = get_credentials(args, margin=SERVE_REFRESH_AHEAD)
+            write_profile(credentials, args.target_profile)
+        except Exception as e:
+            print(f'Failed to refresh credentials, retrying in {SERVE_RETRY_INTERVAL}s. Error: {e}')
+            sleep(SERVE_RETRY_INTERVAL)
+            continue
+
+        sleep(max(seconds_to_expiry(credentials) - SERVE_REFRESH_AHEAD, SERVE_RETRY_INTERVAL))
+
+
 def main():
     args = parse_cmd()
+
+    if args.credential_process:
+        # stdout belongs to the AWS SDK, which expects nothing but the credentials JSON there
+        with redirect_stdout(sys.stderr):
+            credentials = get_credentials(args, args.no_cache)
+
+        print(format_credential_process(credentials))
+
+        return
+
     print(f'Executing script with following parameters:\n{args}\n')
 
     source_profile = args.source_profile
@@ -86,9 +312,20 @@ def main():
     role_name = args.role
     account_id = args.account_id
 
-    credentials = assume_role(account_id, role_name,
-                              source_profile, target_profile)
-    set_profile(credentials, target_profile)
+    if args.serve:
+        serve(args)
+
+        return
+
+    if args.use_cli:
+        credentials = assume_role(account_id, role_name,
+                                  source_profile, target_profile, args.duration_seconds)
+        set_profile(credentials, target_profile)
+
+        return
+
+    credentials = get_credentials(args, args.no_cache)
+    write_profile(credentials, target_profile)
 
     return
 
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import argparse
+from time import perf_counter
+
+from boto3.dynamodb.types import TypeDeserializer
+
+# Makes the shared cloud_scripts package importable when the benchmark is run directly from the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cloud_scripts.deserializer import ItemDeserializer  # noqa: E402
+
+
+# Item shapes as returned by the low-level client: a Cognito user backup and an item with nested values
+SHAPES = {
+    'flat': {
+        'sub': {'S': '6f1c2a8e-3b4d-4c5e-8f9a-0b1c2d3e4f5a'},
+        'username': {'S': 'user@example.com'},
+        'email': {'S': 'user@example.com'},
+        'status': {'S': 'CONFIRMED'},
+        'tenant': {'S': 'tenant-1'},
+        'created': {'N': '1700000000'},
+        'enabled': {'BOOL': True},
+    },
+    'nested': {
+        'id': {'S': 'order-1'},
+        'total': {'N': '129.95'},
+        'quantity': {'N': '3'},
+        'tags': {'SS': ['new', 'priority']},
+        'address': {'M': {'city': {'S': 'Berlin'}, 'zip': {'S': '10115'}, 'floor': {'N': '2'}}},
+        'lines': {'L': [{'M': {'sku': {'S': 'a-1'}, 'price': {'N': '43.3'}}}, {'NULL': True}]},
+    },
+}
+
+
+def parse_cmd():
+    p = argparse.ArgumentParser()
+
+    p.add_argument(
+        '-n',
+        '--items',
+        help='Number of items deserialized in every run (default - 100000)',
+        default=100000
+    )
+
+    p.add_argument(
+        '--repeat',
+        help='Number of runs, the fastest one is reported (default - 5)',
+        default=5
+    )
+
+    p.add_argument(
+        '-o',
+        '--output',
+        help='Save results to this JSON file'
+    )
+
+    args = p.parse_args()
+
+    return args
+
+
+def boto3_path():
+    # The path scripts used before: generic TypeDeserializer over every attribute
+    deserializer = TypeDeserializer()
+
+    return lambda item: {k: deserializer.deserialize(v) for k, v in item.items()}
+
+
+DESERIALIZERS = {
+    'boto3': boto3_path,
+    'specialized': lambda: ItemDeserializer(),
+    'specialized-native': lambda: ItemDeserializer(native_numbers=True),
+}
+
+
+def measure(deserialize, items, repeat):
+    best = None
+
+    for _ in range(repeat):
+        started = perf_counter()
+        for item in items:
+            deserialize(item)
+        elapsed = perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main():
+    args = parse_cmd()
+    items_num = int(args.items)
+    repeat = int(args.repeat)
+    results = []
+
+    for shape, item in SHAPES.items():
+        items = [dict(item) for _ in range(items_num)]
+        expected = boto3_path()(item)
+
+        if ItemDeserializer()(item) != expected:
+            print(f'Specialized deserializer returned a different result for "{shape}" items')
+            exit(1)
+
+        baseline = None
+        for name, create in DESERIALIZERS.items():
+            seconds = measure(create(), items, repeat)
+            baseline = baseline or seconds
+
+            results.append({
+                'shape': shape,
+                'deserializer': name,
+                'items': items_num,
+                'seconds': round(seconds, 4),
+                'items_per_sec': round(items_num / seconds),
+                'speedup': round(baseline / seconds, 2)
+            })
+            print(f'{shape:<8}{name:<20}{items_num / seconds:>12,.0f} items/s{baseline / seconds:>8.2f}x')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+        print(f'\nResults saved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
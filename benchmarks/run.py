@@ -0,0 +1,574 @@
+#!/usr/bin/env python3
+import io
+import os
+import sys
+import json
+import zipfile
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from time import perf_counter
+from datetime import datetime, timezone
+from collections import Counter, defaultdict
+from urllib.request import Request, urlopen
+
+import boto3
+from moto.server import DomainDispatcherApplication, create_backend_app
+from werkzeug.serving import make_server
+
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+REGION = 'us-east-1'
+TABLE_NAME = 'benchmark'
+QUEUE_NAME = 'benchmark'
+ROLE_NAME = 'benchmark'
+# Moto accepts any credentials; fixed ones keep the runner and scripts away from real profiles
+CREDENTIALS = {'aws_access_key_id': 'benchmark', 'aws_secret_access_key': 'benchmark'}
+# Memory of the script processes is sampled with this interval, in seconds
+RSS_SAMPLE_INTERVAL = 0.05
+# Operations the stand-in does not implement, answered with an empty result: (method, path suffix): body
+EMPTY_RESPONSES = {
+    ('GET', '/provisioned-concurrency'): b'{"ProvisionedConcurrencyConfigs": []}'
+}
+
+
+def parse_cmd():
+    p = argparse.ArgumentParser()
+
+    p.add_argument(
+        '-o',
+        '--output',
+        help='The name of the result JSON file (default - benchmark-results.json)',
+        default='benchmark-results.json'
+    )
+
+    p.add_argument(
+        '-b',
+        '--benchmarks',
+        help=f'Comma separated list of benchmarks to run (default - all: {",".join(BENCHMARKS)})',
+        default=','.join(BENCHMARKS)
+    )
+
+    p.add_argument(
+        '-w',
+        '--workers',
+        help='Comma separated list of worker counts every benchmark is run with (default - 1,4)',
+        default='1,4'
+    )
+
+    p.add_argument(
+        '--items',
+        help='Number of DynamoDB items (default - 5000)',
+        default=5000
+    )
+
+    p.add_argument(
+        '--users',
+        help='Number of Cognito users (default - 500)',
+        default=500
+    )
+
+    p.add_argument(
+        '--messages',
+        help='Number of SQS messages (default - 2000)',
+        default=2000
+    )
+
+    p.add_argument(
+        '--functions',
+        help='Number of Lambda functions (default - 10)',
+        default=10
+    )
+
+    p.add_argument(
+        '--versions',
+        help='Number of published versions of every Lambda function (default - 10)',
+        default=10
+    )
+
+    p.add_argument(
+        '--keys',
+        help='Number of KMS keys (default - 100)',
+        default=100
+    )
+
+    p.add_argument(
+        '--baseline',
+        help='Result JSON file of a previous run to compare items/sec against'
+    )
+
+    args = p.parse_args()
+
+    return args
+
+
+class CountingApp:
+    # WSGI middleware, which counts API calls by service and operation on the server side,
+    # so calls made by every process and thread of a script are included
+    def __init__(self, app):
+        self.app = app
+        self.calls = defaultdict(Counter)
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        service, operation = request_operation(environ)
+
+        if service:
+            with self.lock:
+                self.calls[service][operation] += 1
+
+        for (method, suffix), body in EMPTY_RESPONSES.items():
+            if environ['REQUEST_METHOD'] == method and environ.get('PATH_INFO', '').endswith(suffix):
+                start_response('200 OK', [('Content-Type', 'application/json')])
+                return [body]
+
+        return self.app(environ, start_response)
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return {service: dict(operations) for service, operations in self.calls.items()}
+
+
+def request_operation(environ):
+    # Service name is taken from the SigV4 credential scope: Credential=<key>/<date>/<region>/<service>/aws4_request
+    authorization = environ.get('HTTP_AUTHORIZATION', '')
+    if 'Credential=' not in authorization:
+        return None, None
+
+    service = authorization.split('Credential=')[1].split(',')[0].split('/')[3]
+    target = environ.get('HTTP_X_AMZ_TARGET')
+
+    if target:
+        operation = target.split('.')[-1]
+    else:
+        # REST protocols (f.e. Lambda) encode the operation in the method and path: /<api version>/<collection>/<name>/...
+        path = environ.get('PATH_INFO', '/').strip('/').split('/')
+        if len(path) > 2:
+            path[2] = '{name}'
+        operation = f'{environ["REQUEST_METHOD"]} /{"/".join(path)}'
+
+    return service, operation
+
+
+def start_server():
+    app = CountingApp(DomainDispatcherApplication(create_backend_app))
+    # Request log of the server would be mixed with the results
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    endpoint = f'http://127.0.0.1:{server.server_port}'
+    print(f'Moto server is running on {endpoint}')
+
+    return server, app, endpoint
+
+
+def reset_server(endpoint):
+    urlopen(Request(f'{endpoint}/moto-api/reset', method='POST')).read()
+
+
+def client(endpoint, service_name):
+    return boto3.client(service_name, region_name=REGION, endpoint_url=endpoint, **CREDENTIALS)
+
+
+def seed_dynamodb(endpoint, volumes):
+    dynamodb = client(endpoint, 'dynamodb')
+    dynamodb.create_table(
+        TableName=TABLE_NAME,
+        KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+    table = boto3.resource('dynamodb', region_name=REGION, endpoint_url=endpoint, **CREDENTIALS).Table(TABLE_NAME)
+    with table.batch_writer() as writer:
+        for i in range(volumes['items']):
+            writer.put_item(Item={'id': f'item-{i}', 'number': i, 'payload': 'x' * 200})
+
+    return {'table': TABLE_NAME}, volumes['items']
+
+
+def seed_cognito(endpoint, volumes):
+    cognito = client(endpoint, 'cognito-idp')
+    user_pool_id = cognito.create_user_pool(PoolName='benchmark')['UserPool']['Id']
+
+    for i in range(volumes['users']):
+        cognito.admin_create_user(
+            UserPoolId=user_pool_id,
+            Username=f'user-{i}',
+            UserAttributes=[{'Name': 'email', 'Value': f'user-{i}@example.com'}]
+        )
+
+    return {'userpool': user_pool_id}, volumes['users']
+
+
+def seed_sqs(endpoint, volumes):
+    sqs = client(endpoint, 'sqs')
+    queue_url = sqs.create_queue(QueueName=QUEUE_NAME, Attributes={'VisibilityTimeout': '600'})['QueueUrl']
+
+    for start in range(0, volumes['messages'], 10):
+        sqs.send_message_batch(
+            QueueUrl=queue_url,
+            Entries=[
+                {'Id': str(i), 'MessageBody': json.dumps({'number': i, 'payload': 'x' * 200})}
+                for i in range(start, min(start + 10, volumes['messages']))
+            ]
+        )
+
+    return {'url': queue_url}, volumes['messages']
+
+
+def seed_lambda(endpoint, volumes):
+    iam = client(endpoint, 'iam')
+    role_arn = iam.create_role(RoleName=ROLE_NAME, AssumeRolePolicyDocument='{}')['Role']['Arn']
+
+    aws_lambda = client(endpoint, 'lambda')
+    for f in range(volumes['functions']):
+        aws_lambda.create_function(
+            FunctionName=f'benchmark-{f}',
+            Runtime='python3.13',
+            Role=role_arn,
+            Handler='index.handler',
+            Code={'ZipFile': lambda_package(0)}
+        )
+
+        for v in range(volumes['versions']):
+            aws_lambda.update_function_code(FunctionName=f'benchmark-{f}', ZipFile=lambda_package(v + 1), Publish=True)
+
+    return {}, volumes['functions'] * volumes['versions']
+
+
+def lambda_package(version):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as package:
+        package.writestr('index.py', f'def handler(event, context):\n    return {version}\n')
+
+    return buffer.getvalue()
+
+
+def seed_kms(endpoint, volumes):
+    kms = client(endpoint, 'kms')
+    for _ in range(volumes['keys']):
+        kms.create_key()
+
+    return {}, volumes['keys']
+
+
+def dynamodb_delete_records_args(seeded, workers, work_dir):
+    return [
+        '-d', seeded['table'], '-k', 'id',
+        '--stream', '--workers', str(workers), '--segments', str(workers)
+    ]
+
+
+def cognito_extract_users_args(seeded, workers, work_dir):
+    args = ['-u', seeded['userpool'], '-f', 'jsonl', '--compact']
+    if workers > 1:
+        args += ['--shard-workers', str(workers)]
+
+    return args
+
+
+def cognito_delete_users_args(seeded, workers, work_dir):
+    return ['-u', seeded['userpool'], '--threads', str(workers)]
+
+
+def sqs_extract_messages_args(seeded, workers, work_dir):
+    return [
+        '-u', seeded['url'], '-f', os.path.join(work_dir, 'messages.jsonl'),
+        '--receivers', str(workers), '--wait-time', '1', '--delete'
+    ]
+
+
+def lambda_delete_versions_args(seeded, workers, work_dir):
+    return ['--workers', str(workers)]
+
+
+def kms_delete_keys_args(seeded, workers, work_dir):
+    return ['--workers', str(workers)]
+
+
+def count_lines(filename):
+    if not os.path.exists(filename):
+        return 0
+
+    with open(filename) as f:
+        return sum(1 for line in f if line.strip())
+
+
+# Not every script exits non-zero when it fails on some items, so every benchmark counts the items
+# which were actually processed: deleted from the stand-in or written to the output file
+def deleted_records(endpoint, seeded, work_dir, items):
+    remaining = 0
+    for page in client(endpoint, 'dynamodb').get_paginator('scan').paginate(TableName=seeded['table'], Select='COUNT'):
+        remaining += page['Count']
+
+    return items - remaining
+
+
+def extracted_users(endpoint, seeded, work_dir, items):
+    return count_lines(os.path.join(work_dir, 'users_data.jsonl'))
+
+
+def deleted_users(endpoint, seeded, work_dir, items):
+    remaining = 0
+    for page in client(endpoint, 'cognito-idp').get_paginator('list_users').paginate(UserPoolId=seeded['userpool']):
+        remaining += len(page['Users'])
+
+    return items - remaining
+
+
+def extracted_messages(endpoint, seeded, work_dir, items):
+    return count_lines(os.path.join(work_dir, 'messages.jsonl'))
+
+
+def deleted_versions(endpoint, seeded, work_dir, items):
+    aws_lambda = client(endpoint, 'lambda')
+    remaining = 0
+
+    for page in aws_lambda.get_paginator('list_functions').paginate():
+        for function in page['Functions']:
+            versions = aws_lambda.list_versions_by_function(FunctionName=function['FunctionName'])['Versions']
+            remaining += sum(1 for version in versions if version['Version'] != '$LATEST')
+
+    return items - remaining
+
+
+def scheduled_keys(endpoint, seeded, work_dir, items):
+    kms = client(endpoint, 'kms')
+    scheduled = 0
+
+    for page in kms.get_paginator('list_keys').paginate():
+        for key in page['Keys']:
+            if kms.describe_key(KeyId=key['KeyId'])['KeyMetadata']['KeyState'] == 'PendingDeletion':
+                scheduled += 1
+
+    return scheduled
+
+
+# Benchmark name: (script, seeding function, function returning script arguments, function counting processed items)
+BENCHMARKS = {
+    'dynamodb-delete-records': (
+        'aws/dynamodb/delete-records.py', seed_dynamodb, dynamodb_delete_records_args, deleted_records
+    ),
+    'cognito-extract-users': (
+        'aws/cognito/extract-users.py', seed_cognito, cognito_extract_users_args, extracted_users
+    ),
+    'cognito-delete-users': (
+        'aws/cognito/delete-users.py', seed_cognito, cognito_delete_users_args, deleted_users
+    ),
+    'sqs-extract-messages': (
+        'aws/sqs/extract-messages.py', seed_sqs, sqs_extract_messages_args, extracted_messages
+    ),
+    'lambda-delete-versions': (
+        'aws/lambda/delete-versions.py', seed_lambda, lambda_delete_versions_args, deleted_versions
+    ),
+    'kms-delete-keys': (
+        'aws/kms/delete-keys.py', seed_kms, kms_delete_keys_args, scheduled_keys
+    ),
+}
+
+
+def script_env(endpoint, work_dir):
+    env = dict(os.environ)
+    for name in ('AWS_PROFILE', 'AWS_DEFAULT_PROFILE', 'AWS_SESSION_TOKEN'):
+        env.pop(name, None)
+
+    # Scripts reach the stand-in through the endpoint override and never see real profiles
+    env.update(
+        AWS_ENDPOINT_URL=endpoint,
+        AWS_ACCESS_KEY_ID=CREDENTIALS['aws_access_key_id'],
+        AWS_SECRET_ACCESS_KEY=CREDENTIALS['aws_secret_access_key'],
+        AWS_DEFAULT_REGION=REGION,
+        AWS_CONFIG_FILE=os.path.join(work_dir, 'config'),
+        AWS_SHARED_CREDENTIALS_FILE=os.path.join(work_dir, 'credentials')
+    )
+
+    return env
+
+
+def process_tree(pid):
+    pids = [pid]
+
+    for task in os.listdir(f'/proc/{pid}/task'):
+        with open(f'/proc/{pid}/task/{task}/children') as f:
+            for child in f.read().split():
+                pids.extend(process_tree(int(child)))
+
+    return pids
+
+
+def process_rss(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+    return 0
+
+
+def sample_rss(pid, stop, peak):
+    # Resident memory of the script and its pool processes, sampled from /proc. ru_maxrss of the
+    # child can not be used, as Linux carries the runner's own peak over fork and exec
+    while not stop.wait(RSS_SAMPLE_INTERVAL):
+        try:
+            peak[0] = max(peak[0], sum(process_rss(p) for p in process_tree(pid)))
+        except (OSError, ValueError):
+            # Processes exit while the tree is being read
+            continue
+
+
+def run_script(script, args, env, work_dir):
+    with open(os.path.join(work_dir, 'output.log'), 'w+') as output:
+        start = perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(REPO_DIR, script), '-r', REGION] + args,
+            cwd=work_dir,
+            env=env,
+            stdout=output,
+            stderr=subprocess.STDOUT
+        )
+
+        stop = threading.Event()
+        peak = [0]
+        sampler = threading.Thread(target=sample_rss, args=(process.pid, stop, peak), daemon=True)
+        if os.path.isdir('/proc'):
+            sampler.start()
+
+        returncode = process.wait()
+        seconds = perf_counter() - start
+        stop.set()
+
+        output.seek(0)
+        lines = output.read().strip().splitlines()
+
+    return returncode, seconds, peak[0] / 1024, lines
+
+
+def run_benchmark(name, workers, volumes, app, endpoint):
+    script, seed, script_args, count_processed = BENCHMARKS[name]
+
+    reset_server(endpoint)
+    seeded, items = seed(endpoint, volumes)
+    app.reset()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        returncode, seconds, peak_rss, output = run_script(
+            script, script_args(seeded, workers, work_dir), script_env(endpoint, work_dir), work_dir
+        )
+        api_calls = app.snapshot()
+        processed = count_processed(endpoint, seeded, work_dir, items)
+
+    result = {
+        'benchmark': name,
+        'workers': workers,
+        'items': items,
+        'processed': processed,
+        'seconds': round(seconds, 3),
+        'items_per_sec': round(processed / seconds, 1),
+        'peak_rss_mib': round(peak_rss, 1),
+        'api_calls': api_calls,
+        'api_calls_total': sum(sum(operations.values()) for operations in api_calls.values()),
+        'returncode': returncode
+    }
+
+    if returncode or processed != items:
+        result['error'] = output[-5:]
+        print(
+            f'{name} (workers: {workers}) failed: exit code {returncode}, processed {processed} of {items} items. '
+            f'Script output:\n' + '\n'.join(output[-5:])
+        )
+    else:
+        print(
+            f'{name} (workers: {workers}): {items} items in {result["seconds"]}s, '
+            f'{result["items_per_sec"]} items/s, peak RSS {result["peak_rss_mib"]} MiB, '
+            f'{result["api_calls_total"]} API calls'
+        )
+
+    return result
+
+
+def get_revision():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_with_baseline(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = {(r['benchmark'], r['workers']): r for r in json.load(f)['results']}
+
+    print(f'\nComparison with {baseline_file}:')
+    for result in results:
+        previous = baseline.get((result['benchmark'], result['workers']))
+        if not previous or 'error' in result or 'error' in previous:
+            continue
+
+        change = (result['items_per_sec'] / previous['items_per_sec'] - 1) * 100
+        print(
+            f'{result["benchmark"]} (workers: {result["workers"]}): '
+            f'{previous["items_per_sec"]} -> {result["items_per_sec"]} items/s ({change:+.1f}%), '
+            f'API calls {previous["api_calls_total"]} -> {result["api_calls_total"]}'
+        )
+
+
+def main():
+    args = parse_cmd()
+
+    names = args.benchmarks.split(',')
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        print(f'Unknown benchmarks: {", ".join(unknown)}')
+        exit(1)
+
+    workers_list = [int(workers) for workers in args.workers.split(',')]
+    volumes = {
+        'items': int(args.items),
+        'users': int(args.users),
+        'messages': int(args.messages),
+        'functions': int(args.functions),
+        'versions': int(args.versions),
+        'keys': int(args.keys)
+    }
+
+    server, app, endpoint = start_server()
+
+    results = []
+    try:
+        for name in names:
+            for workers in workers_list:
+                results.append(run_benchmark(name, workers, volumes, app, endpoint))
+    finally:
+        server.shutdown()
+
+    report = {
+        'revision': get_revision(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'boto3': boto3.__version__,
+        'volumes': volumes,
+        'results': results
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
+
+    print(f'\nResults saved to {args.output}')
+
+    if args.baseline:
+        compare_with_baseline(results, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,4 @@
+from cloud_scripts.cli import main
+
+
+main()
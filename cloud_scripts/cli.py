@@ -0,0 +1,86 @@
+import os
+import sys
+import runpy
+import argparse
+import importlib
+
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Scripts are packaged into cloud_scripts/aws when installed and live in aws/ of the repository checkout
+SCRIPTS_DIRS = (
+    os.path.join(PACKAGE_DIR, 'aws'),
+    os.path.join(PACKAGE_DIR, '..', 'aws'),
+)
+
+# Command name: (script path relative to the scripts directory, description)
+COMMANDS = {
+    'sts-switch-role': ('sts-switch-role.py', 'Assume IAM role and save credentials to a profile'),
+    'kms-delete-keys': ('kms/delete-keys.py', 'Schedule deletion of all customer managed KMS keys'),
+    'dynamodb-delete-records': ('dynamodb/delete-records.py', 'Delete all records from a DynamoDB table'),
+    'cognito-delete-users': ('cognito/delete-users.py', 'Delete all users from a Cognito User Pool'),
+    'cognito-extract-users': ('cognito/extract-users.py', 'Extract all users from a Cognito User Pool or DynamoDB'),
+    'lambda-delete-versions': ('lambda/delete-versions.py', 'Delete all Lambda function versions except $LATEST'),
+    'sqs-extract-messages': ('sqs/extract-messages.py', 'Extract all messages from an SQS queue'),
+}
+
+# Command name: (module of the package with a main(argv) function, description)
+PACKAGE_COMMANDS = {
+    'fanout': ('cloud_scripts.fanout', 'Run a command concurrently across regions and profiles or assumed roles'),
+}
+
+
+def parse_cmd(argv=None):
+    p = argparse.ArgumentParser(
+        prog='cloud-scripts',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='commands:\n' + '\n'.join(
+            f'  {name:<26}{description}' for name, (_, description) in {**COMMANDS, **PACKAGE_COMMANDS}.items()
+        )
+    )
+
+    p.add_argument(
+        'command',
+        help='The name of the command to run, see the list below',
+        choices=list(COMMANDS) + list(PACKAGE_COMMANDS),
+        metavar='command'
+    )
+
+    p.add_argument(
+        'args',
+        help='Arguments of the command, run "cloud-scripts <command> -h" to list them',
+        nargs=argparse.REMAINDER
+    )
+
+    args = p.parse_args(argv)
+
+    return args
+
+
+def find_script(path):
+    for scripts_dir in SCRIPTS_DIRS:
+        script = os.path.join(scripts_dir, path)
+        if os.path.isfile(script):
+            return script
+
+    print(f'Script {path} is not found in {", ".join(SCRIPTS_DIRS)}')
+    exit(1)
+
+
+def main(argv=None):
+    # Only the standard library is imported here: boto3 is loaded by the command itself,
+    # once it has parsed its arguments and creates a session
+    args = parse_cmd(argv)
+
+    if args.command in PACKAGE_COMMANDS:
+        importlib.import_module(PACKAGE_COMMANDS[args.command][0]).main(args.args)
+        return
+
+    script = find_script(COMMANDS[args.command][0])
+
+    # Scripts parse sys.argv, run_path replaces its first item with the script path
+    sys.argv = [script] + args.args
+    runpy.run_path(script, run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()
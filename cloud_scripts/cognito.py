@@ -0,0 +1,66 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+SUB_ALPHABET = '0123456789abcdef'
+# Positions of dashes in the UUID stored as user "sub"
+SUB_DASHES = (8, 13, 18, 23)
+# Shards which turn out to hold more users are split into sub-prefixes
+SHARD_USERS = 6000
+
+
+def user_sub(user):
+    return next(item['Value'] for item in user['Attributes'] if item['Name'] == 'sub')
+
+
+def list_users_shard(client, user_pool_id, prefix, seen):
+    # Lists users whose "sub" starts with prefix; returns users, sub-prefixes to list if the shard
+    # is too big, and subs already listed which sub-prefixes must skip
+    paginator = client.get_paginator('list_users')
+    filter_args = {'Filter': f'sub ^= "{prefix}"'} if prefix else {}
+    users = []
+
+    response_iterator = paginator.paginate(
+        UserPoolId=user_pool_id,
+        **filter_args
+    )
+
+    for page in response_iterator:
+        users.extend(user for user in page['Users'] if user_sub(user) not in seen)
+
+        if len(users) >= SHARD_USERS and page.get('PaginationToken'):
+            next_chars = '-' if len(prefix) in SUB_DASHES else SUB_ALPHABET
+
+            return users, [prefix + c for c in next_chars], seen | {user_sub(user) for user in users}
+
+    return users, [], seen
+
+
+def iter_users_sharded(client, user_pool_id, workers, state=None):
+    # Splits the pool into disjoint "sub" prefix ranges and lists them concurrently; the client must have
+    # a connection pool of at least workers connections.
+    # Yields users of every finished shard along with the shards left to list
+    if state is not None:
+        shards = [(prefix, frozenset(seen)) for prefix, seen in state['shards']]
+    else:
+        estimated = client.describe_user_pool(UserPoolId=user_pool_id)['UserPool'].get('EstimatedNumberOfUsers', 0)
+
+        prefixes = ['']
+        while len(prefixes) * SHARD_USERS < estimated:
+            prefixes = [prefix + c for prefix in prefixes for c in SUB_ALPHABET]
+
+        shards = [(prefix, frozenset()) for prefix in prefixes]
+
+    with ThreadPoolExecutor(workers) as executor:
+        pending = {executor.submit(list_users_shard, client, user_pool_id, *shard): shard for shard in shards}
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                del pending[future]
+                users, sub_prefixes, seen = future.result()
+
+                for prefix in sub_prefixes:
+                    pending[executor.submit(list_users_shard, client, user_pool_id, prefix, seen)] = (prefix, seen)
+
+                yield users, {'shards': [(prefix, sorted(seen)) for prefix, seen in pending.values()]}
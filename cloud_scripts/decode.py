@@ -0,0 +1,185 @@
+import os
+import re
+import gzip
+import json
+import zlib
+import base64
+import binascii
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+BASE64_PATTERN = re.compile(r'^[A-Za-z0-9+/\s]+={0,2}\s*$')
+GZIP_MAGIC = b'\x1f\x8b'
+# First bytes of zlib streams with the default window size and any compression level
+ZLIB_HEADERS = (b'\x78\x01', b'\x78\x5e', b'\x78\x9c', b'\x78\xda')
+# Bodies shorter than this are not taken for base64, a short word is often valid base64 too
+MIN_BASE64_LENGTH = 16
+
+
+def number(value):
+    # Values which are not numbers after all are kept as strings
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except (TypeError, ValueError):
+            pass
+
+    return value
+
+
+def flatten_message_attributes(attributes):
+    # SQS attributes {"name": {"DataType": "Number", "StringValue": "1"}} become {"name": 1};
+    # binary values are kept base64 encoded
+    flat = {}
+
+    for name, attribute in (attributes or {}).items():
+        data_type = attribute.get('DataType', 'String')
+
+        if data_type.startswith('Binary'):
+            value = attribute.get('BinaryValue', b'')
+            flat[name] = base64.b64encode(value).decode() if isinstance(value, bytes) else value
+        elif data_type.startswith('Number'):
+            flat[name] = number(attribute['StringValue'])
+        else:
+            flat[name] = attribute.get('StringValue')
+
+    return flat
+
+
+def flatten_sns_attributes(attributes):
+    # SNS attributes {"name": {"Type": "Number", "Value": "1"}} become {"name": 1}
+    flat = {}
+
+    for name, attribute in (attributes or {}).items():
+        value = attribute.get('Value')
+        flat[name] = number(value) if attribute.get('Type', '').startswith('Number') else value
+
+    return flat
+
+
+def parse_json(text):
+    # Only objects and arrays are parsed, so plain strings and numbers in bodies stay as they are
+    stripped = text.strip()
+    if stripped[:1] in ('{', '['):
+        try:
+            return json.loads(stripped), True
+        except ValueError:
+            pass
+
+    return text, False
+
+
+def decode_base64(text):
+    # Base64 is decoded only when the result is compressed or JSON, otherwise the text is kept
+    if len(text) < MIN_BASE64_LENGTH or not BASE64_PATTERN.match(text):
+        return None, []
+
+    try:
+        data = base64.b64decode(text, validate=False)
+    except (binascii.Error, ValueError):
+        return None, []
+
+    steps = ['base64']
+    if data[:2] == GZIP_MAGIC:
+        data = gzip.decompress(data)
+        steps.append('gzip')
+    elif data[:2] in ZLIB_HEADERS:
+        data = zlib.decompress(data)
+        steps.append('zlib')
+
+    try:
+        text = data.decode()
+    except UnicodeDecodeError:
+        return None, []
+
+    value, parsed = parse_json(text)
+    if not parsed and len(steps) == 1:
+        return None, []
+
+    return value, steps + (['json'] if parsed else [])
+
+
+def decode_payload(text):
+    # Returns the decoded value and the list of decoding steps applied to it
+    value, parsed = parse_json(text)
+    if parsed:
+        return value, ['json']
+
+    value, steps = decode_base64(text)
+    if steps:
+        return value, steps
+
+    return text, []
+
+
+def is_sns_envelope(value):
+    return isinstance(value, dict) and value.get('Type') == 'Notification' and 'TopicArn' in value and 'Message' in value
+
+
+def decode_message(message):
+    record = {
+        'MessageId': message['MessageId'],
+        'Attributes': message.get('Attributes', {}),
+        'MessageAttributes': flatten_message_attributes(message.get('MessageAttributes')),
+    }
+
+    try:
+        body, steps = decode_payload(message['Body'])
+
+        if is_sns_envelope(body):
+            # Messages delivered by an SNS subscription without raw message delivery
+            record['Sns'] = {
+                'TopicArn': body['TopicArn'],
+                'MessageId': body.get('MessageId'),
+                'Subject': body.get('Subject'),
+                'Timestamp': body.get('Timestamp'),
+                'MessageAttributes': flatten_sns_attributes(body.get('MessageAttributes')),
+            }
+            body, message_steps = decode_payload(body['Message'])
+            steps = ['sns'] + message_steps
+
+        record['Body'] = body
+        record['Decoding'] = steps
+    except Exception as e:
+        record['Body'] = message['Body']
+        record['Decoding'] = []
+        record['DecodeError'] = f'{type(e).__name__}: {e}'
+
+    return record
+
+
+def decode_messages(messages):
+    return [decode_message(message) for message in messages]
+
+
+class Decoder:
+    # Decodes chunks of messages on a process pool, so the CPU-bound work doesn't hold up the threads which
+    # receive and write messages. Results come back in submission order, each with the payload of its chunk.
+    # Workers are started by a fork server, forking a process which already runs threads is not safe
+    def __init__(self, workers=None, chunk_size=500, max_pending=None):
+        workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('forkserver'))
+        self.max_pending = max_pending or workers * 2
+        self.pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, messages, payload=None):
+        self.pending.append((self.executor.submit(decode_messages, messages), payload))
+
+    def completed(self, wait=False):
+        # Decoded chunks which are finished, in order; waits while too many chunks are pending, or for all with wait
+        while self.pending and (wait or self.pending[0][0].done() or len(self.pending) > self.max_pending):
+            future, payload = self.pending.popleft()
+
+            yield future.result(), payload
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
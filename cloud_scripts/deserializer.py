@@ -0,0 +1,90 @@
+from decimal import Decimal
+
+
+# Number of distinct item shapes (sets of attribute names) a deserializer compiles specialized functions for;
+# items of other shapes are deserialized attribute by attribute
+MAX_SHAPES = 256
+
+# Expressions reading scalar and set attributes of a known type; a different type raises KeyError.
+# Lists and maps are deserialized recursively by value()
+SCALAR_EXPRESSIONS = {
+    'S': '{attr}["S"]',
+    'N': 'number({attr}["N"])',
+    'B': '{attr}["B"]',
+    'BOOL': '{attr}["BOOL"]',
+    'NULL': '({attr}["NULL"] and None)',
+    'SS': 'set({attr}["SS"])',
+    'NS': 'set(map(number, {attr}["NS"]))',
+    'BS': 'set({attr}["BS"])',
+}
+
+
+def native_number(value):
+    # DynamoDB numbers are strings; integers become int, anything with a fraction or exponent - float
+    if '.' in value or 'e' in value or 'E' in value:
+        return float(value)
+
+    return int(value)
+
+
+class ItemDeserializer:
+    # Faster replacement for TypeDeserializer().deserialize applied to every attribute of an item.
+    # Items of the same shape (most items of a table or a projection) are deserialized by a function compiled
+    # for the attribute names and types of the first such item, without per-attribute dispatch.
+    # Numbers are Decimal like in boto3, or int/float with native_numbers; binary values are bytes
+    def __init__(self, native_numbers=False):
+        self.number = native_number if native_numbers else Decimal
+        self.shapes = {}
+        self.types = {
+            'S': lambda value: value,
+            'N': self.number,
+            'B': lambda value: value,
+            'BOOL': lambda value: value,
+            'NULL': lambda value: None,
+            'SS': set,
+            'NS': lambda values: set(map(self.number, values)),
+            'BS': set,
+            'L': lambda values: [self.value(v) for v in values],
+            'M': lambda values: {k: self.value(v) for k, v in values.items()},
+        }
+
+    def __call__(self, item):
+        shape = tuple(item)
+        deserialize = self.shapes.get(shape)
+
+        if deserialize is None:
+            if len(self.shapes) >= MAX_SHAPES:
+                return self.generic(item)
+
+            deserialize = self.shapes[shape] = self.compile(item)
+
+        try:
+            return deserialize(item)
+        except KeyError:
+            # Same attribute names, but some attribute has a different type than in the compiled shape
+            return self.generic(item)
+
+    def value(self, attribute):
+        [(attribute_type, value)] = attribute.items()
+
+        return self.types[attribute_type](value)
+
+    def generic(self, item):
+        return {name: attribute['S'] if 'S' in attribute else self.value(attribute) for name, attribute in item.items()}
+
+    def compile(self, item):
+        fields = []
+
+        for name, attribute in item.items():
+            [attribute_type] = attribute
+            attr = f'item[{name!r}]'
+
+            if attribute_type in SCALAR_EXPRESSIONS:
+                fields.append(f'{name!r}: ' + SCALAR_EXPRESSIONS[attribute_type].format(attr=attr))
+            else:
+                fields.append(f'{name!r}: value({attr})')
+
+        namespace = {'number': self.number, 'value': self.value}
+        exec('def deserialize(item):\n    return {' + ', '.join(fields) + '}\n', namespace)
+
+        return namespace['deserialize']
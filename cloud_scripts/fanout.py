@@ -0,0 +1,339 @@
+import os
+import re
+import sys
+import json
+import argparse
+import threading
+import subprocess
+from time import monotonic
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from cloud_scripts import metrics
+from cloud_scripts.cli import COMMANDS, find_script
+
+
+# Cleanup commands which act on every resource of a region and don't write output files, so they can run in
+# many regions and accounts at once. Commands taking a queue, pool or table name or writing to a fixed file don't
+FANOUT_COMMANDS = ['kms-delete-keys', 'lambda-delete-versions']
+# Variables which would make a run with assumed role credentials use a profile instead
+PROFILE_VARIABLES = ('AWS_PROFILE', 'AWS_DEFAULT_PROFILE')
+
+
+def parse_cmd(argv=None):
+    p = argparse.ArgumentParser(
+        prog='cloud-scripts fanout',
+        description='Run a command concurrently in every combination of regions and profiles or assumed roles'
+    )
+
+    p.add_argument(
+        '-r',
+        '--regions',
+        help='Comma-separated names of AWS regions, f.e. us-east-1,eu-west-1',
+        required=True
+    )
+
+    p.add_argument(
+        '-p',
+        '--profiles',
+        help='Comma-separated names of AWS profiles; the default profile is used when neither profiles nor roles are set'
+    )
+
+    p.add_argument(
+        '--role-arns',
+        help='Comma-separated ARNs of IAM roles to assume, f.e. one role per account of an organization'
+    )
+
+    p.add_argument(
+        '--source-profile',
+        help='The name of the AWS profile which assumes --role-arns (default - the default profile)'
+    )
+
+    p.add_argument(
+        '--role-session-name',
+        help='Session name of assumed roles (default - cloud-scripts-fanout)',
+        default='cloud-scripts-fanout'
+    )
+
+    p.add_argument(
+        '--jobs',
+        help='Maximum number of commands running at the same time (default - 8)',
+        default=8
+    )
+
+    p.add_argument(
+        '--per-region',
+        help='Maximum number of commands running at the same time in one region (default - 2)',
+        default=2
+    )
+
+    p.add_argument(
+        '--log-dir',
+        help='Directory for the output and API call metrics of every run (default - fanout-logs)',
+        default='fanout-logs'
+    )
+
+    p.add_argument(
+        '--report',
+        help='Save the result of every run to this JSON file'
+    )
+
+    p.add_argument(
+        '--metrics-file',
+        help='Save API call metrics of all runs together to this file: '
+             '".prom" - Prometheus text format, any other extension - JSON'
+    )
+
+    p.add_argument(
+        'command',
+        help='The name of the command to run: ' + ', '.join(FANOUT_COMMANDS),
+        choices=FANOUT_COMMANDS,
+        metavar='command'
+    )
+
+    p.add_argument(
+        'args',
+        help='Arguments of the command, except for --region, --profile-name and --metrics-file',
+        nargs=argparse.REMAINDER
+    )
+
+    args = p.parse_args(argv)
+
+    return args
+
+
+def split_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()] if value else []
+
+
+class Target:
+    def __init__(self, region, profile=None, role_arn=None):
+        self.region = region
+        self.profile = profile
+        self.role_arn = role_arn
+
+    @property
+    def account(self):
+        if self.role_arn:
+            # arn:aws:iam::123456789012:role/name
+            parts = self.role_arn.split(':')
+            return f'{parts[4]}/{parts[5].split("/")[-1]}'
+
+        return self.profile or 'default'
+
+    @property
+    def name(self):
+        return re.sub(r'[^\w.-]+', '_', f'{self.region}-{self.account}')
+
+
+class Scheduler:
+    # Hands out targets to worker threads so that no more than per_region commands run in one region at a time.
+    # A worker takes the first pending target of a region with a free slot, so regions are swept in parallel
+    def __init__(self, targets, per_region):
+        self.pending = list(targets)
+        self.per_region = per_region
+        self.running = Counter()
+        self.condition = threading.Condition()
+
+    def next(self):
+        with self.condition:
+            while self.pending:
+                for i, target in enumerate(self.pending):
+                    if self.running[target.region] < self.per_region:
+                        self.running[target.region] += 1
+                        return self.pending.pop(i)
+
+                self.condition.wait()
+
+            return None
+
+    def done(self, target):
+        with self.condition:
+            self.running[target.region] -= 1
+            self.condition.notify_all()
+
+
+class RoleCredentials:
+    # Assumes every role once and shares its credentials between the regions it is run in.
+    # Credentials are valid for an hour, which is enough for a sweep of cleanup scripts
+    def __init__(self, source_profile, session_name, region):
+        self.source_profile = source_profile
+        self.session_name = session_name
+        self.region = region
+        self.credentials = {}
+        self.lock = threading.Lock()
+        self.sts_client = None
+
+    def get(self, role_arn):
+        with self.lock:
+            if role_arn not in self.credentials:
+                self.credentials[role_arn] = self.assume_role(role_arn)
+
+            return self.credentials[role_arn]
+
+    def assume_role(self, role_arn):
+        if self.sts_client is None:
+            import boto3
+
+            from cloud_scripts.session import client_config
+
+            self.sts_client = boto3.session.Session(profile_name=self.source_profile, region_name=self.region).client(
+                'sts',
+                config=client_config()
+            )
+
+        credentials = self.sts_client.assume_role(RoleArn=role_arn, RoleSessionName=self.session_name)['Credentials']
+
+        return {
+            'AWS_ACCESS_KEY_ID': credentials['AccessKeyId'],
+            'AWS_SECRET_ACCESS_KEY': credentials['SecretAccessKey'],
+            'AWS_SESSION_TOKEN': credentials['SessionToken'],
+        }
+
+
+def last_line(filename):
+    # Last line a script printed before the API call summary; progress is reported with carriage returns
+    with open(filename, errors='replace') as f:
+        output = f.read()
+
+    summary = output.rfind('\nAPI calls in ')
+    if summary != -1:
+        output = output[:summary]
+
+    lines = [line.strip() for line in re.split(r'[\r\n]', output) if line.strip()]
+
+    return lines[-1] if lines else ''
+
+
+def run_target(target, script, script_args, log_dir, roles):
+    log_file = os.path.join(log_dir, f'{target.name}.log')
+    metrics_file = os.path.join(log_dir, f'{target.name}.metrics.json')
+    result = {
+        'region': target.region,
+        'account': target.account,
+        'log_file': log_file,
+        'exit_code': None,
+        'error': None,
+    }
+
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    cmd = [sys.executable, script, '-r', target.region] + script_args + ['--metrics-file', metrics_file]
+
+    # A metrics file left by an earlier sweep would be counted again
+    if os.path.isfile(metrics_file):
+        os.remove(metrics_file)
+
+    started = monotonic()
+    try:
+        if target.role_arn:
+            for variable in PROFILE_VARIABLES:
+                env.pop(variable, None)
+            env.update(roles.get(target.role_arn))
+        elif target.profile:
+            cmd[4:4] = ['-p', target.profile]
+
+        with open(log_file, 'w') as f:
+            result['exit_code'] = subprocess.run(cmd, stdout=f, stderr=subprocess.STDOUT, env=env).returncode
+    except Exception as e:
+        result['error'] = str(e)
+
+    result['started'] = started
+    result['seconds'] = round(monotonic() - started, 3)
+
+    if os.path.isfile(metrics_file):
+        metrics.merge(metrics.load(metrics_file))
+    if os.path.isfile(log_file):
+        result['output'] = last_line(log_file)
+
+    status = 'ok' if result['exit_code'] == 0 else 'FAILED'
+    print(f'{status:<8}{target.region:<16}{target.account:<32}{result["seconds"]:>8.1f}s')
+
+    return result
+
+
+def worker(scheduler, results, *run_args):
+    while (target := scheduler.next()) is not None:
+        try:
+            results.append(run_target(target, *run_args))
+        finally:
+            scheduler.done(target)
+
+
+def print_report(results, elapsed):
+    # A region takes from the start of its first run to the end of its last one
+    regions = {}
+    for result in results:
+        first, last = regions.get(result['region'], (result['started'], 0))
+        regions[result['region']] = (min(first, result['started']), max(last, result['started'] + result['seconds']))
+
+    print(f'\n{"Region":<16}{"Account":<32}{"Exit":>6}{"Seconds":>9}  Last output')
+    for result in sorted(results, key=lambda r: (r['region'], r['account'])):
+        exit_code = '-' if result['exit_code'] is None else result['exit_code']
+        output = result['error'] or result.get('output', '')
+        print(
+            f'{result["region"]:<16}{result["account"]:<32}{exit_code:>6}{result["seconds"]:>9.1f}  {output[:80]}'
+        )
+
+    failed = sum(1 for result in results if result['exit_code'] != 0)
+    print(f'\nFinished {len(results)} runs in {elapsed:.1f}s, {failed} failed')
+
+    if regions:
+        region, (first, last) = max(regions.items(), key=lambda r: r[1][1] - r[1][0])
+        print(f'Slowest region: {region} ({last - first:.1f}s)')
+
+
+def main(argv=None):
+    args = parse_cmd(argv)
+
+    regions = split_list(args.regions)
+    profiles = split_list(args.profiles)
+    role_arns = split_list(args.role_arns)
+    jobs = int(args.jobs)
+
+    if role_arns:
+        targets = [Target(region, role_arn=role_arn) for role_arn in role_arns for region in regions]
+    else:
+        targets = [Target(region, profile=profile) for profile in profiles or [None] for region in regions]
+
+    if not targets:
+        print('No regions to run the command in')
+        exit(1)
+
+    script = find_script(COMMANDS[args.command][0])
+    # Roles are assumed through the regional STS endpoint of the first region
+    roles = RoleCredentials(args.source_profile, args.role_session_name, regions[0])
+    os.makedirs(args.log_dir, exist_ok=True)
+
+    print(f'Running {args.command} in {len(targets)} region and account combinations, output is saved to {args.log_dir}\n')
+
+    scheduler = Scheduler(targets, int(args.per_region))
+    results = []
+    started = monotonic()
+
+    with ThreadPoolExecutor(min(jobs, len(targets))) as executor:
+        for _ in range(min(jobs, len(targets))):
+            executor.submit(worker, scheduler, results, script, args.args, args.log_dir, roles)
+
+    elapsed = monotonic() - started
+    print_report(results, elapsed)
+    metrics.print_summary()
+
+    if args.metrics_file:
+        metrics.save(args.metrics_file, f'fanout-{args.command}')
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(
+                [{k: v for k, v in result.items() if k != 'started'} for result in results],
+                f,
+                indent=4
+            )
+
+        print(f'Report saved to {args.report}')
+
+    if any(result['exit_code'] != 0 for result in results):
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import pickle
+import sqlite3
+import threading
+from time import time
+
+
+# Listings older than this are listed again, in seconds
+DEFAULT_TTL = 900
+# Processed items are marked done in chunks of this size, one transaction per chunk
+DONE_CHUNK_SIZE = 100
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS listings (
+    account TEXT NOT NULL,
+    region TEXT NOT NULL,
+    resource TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    listed_at REAL NOT NULL,
+    PRIMARY KEY (account, region, resource, scope)
+);
+CREATE TABLE IF NOT EXISTS items (
+    account TEXT NOT NULL,
+    region TEXT NOT NULL,
+    resource TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    last_modified TEXT,
+    done INTEGER NOT NULL DEFAULT 0,
+    data BLOB NOT NULL,
+    PRIMARY KEY (account, region, resource, scope, item_id)
+);
+'''
+
+
+class Inventory:
+    # On-disk cache of listed resources of one account and region, so reruns and retries skip the listing
+    # and continue with items which are not processed yet. A resource is a kind of listing (f.e. "kms-keys"),
+    # scope tells listings of the same kind apart (f.e. the user pool ID).
+    # Items are pickled as they were listed, the cache is a local file of the user who runs the scripts.
+    # Thread-safe: all threads share one connection guarded by a lock
+    def __init__(self, filename, account, region, ttl=DEFAULT_TTL):
+        self.filename = filename
+        self.key = (account, region)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def load(self, resource, scope=''):
+        # Items of a listing which are not done yet, or None when the listing is missing or expired
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT listed_at FROM listings WHERE account = ? AND region = ? AND resource = ? AND scope = ?',
+                (*self.key, resource, scope)
+            ).fetchone()
+
+            if row is None or row[0] + self.ttl < time():
+                return None
+
+            rows = self.connection.execute(
+                'SELECT data FROM items WHERE account = ? AND region = ? AND resource = ? AND scope = ? AND done = 0',
+                (*self.key, resource, scope)
+            ).fetchall()
+
+        return [pickle.loads(data) for data, in rows]
+
+    def save(self, resource, items, scope=''):
+        # Replaces a listing with new (item_id, last_modified, item) tuples and returns items which are not done.
+        # An item listed again with the same last modification time keeps its done flag, as nothing changed since
+        # it was processed; changed items and items without a modification time are processed again
+        with self.lock, self.connection:
+            done = {
+                (item_id, last_modified)
+                for item_id, last_modified in self.connection.execute(
+                    'SELECT item_id, last_modified FROM items '
+                    'WHERE account = ? AND region = ? AND resource = ? AND scope = ? AND done = 1 '
+                    'AND last_modified IS NOT NULL',
+                    (*self.key, resource, scope)
+                )
+            }
+            rows = [
+                (*self.key, resource, scope, item_id, last_modified, int((item_id, last_modified) in done), item)
+                for item_id, last_modified, item in items
+            ]
+
+            self.connection.execute(
+                'DELETE FROM items WHERE account = ? AND region = ? AND resource = ? AND scope = ?',
+                (*self.key, resource, scope)
+            )
+            self.connection.executemany(
+                'INSERT INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [row[:-1] + (pickle.dumps(row[-1]),) for row in rows]
+            )
+            self.connection.execute(
+                'INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?)',
+                (*self.key, resource, scope, time())
+            )
+
+        return [row[-1] for row in rows if not row[-2]]
+
+    def mark_done(self, resource, item_ids, scope=''):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'UPDATE items SET done = 1 WHERE account = ? AND region = ? AND resource = ? AND scope = ? AND item_id = ?',
+                [(*self.key, resource, scope, item_id) for item_id in item_ids]
+            )
+
+    def marker(self, resource, scope='', chunk_size=DONE_CHUNK_SIZE):
+        return DoneMarker(self, resource, scope, chunk_size)
+
+    def get(self, resource, list_items, item_id, last_modified=None, scope=''):
+        # Cached items which are not done yet, or items listed by list_items() when the cache is expired
+        items = self.load(resource, scope)
+        if items is not None:
+            print(f'Using {len(items)} {resource} not processed yet from the inventory cache {self.filename}')
+            return items
+
+        rows = []
+        for item in list_items():
+            modified = last_modified(item) if last_modified else None
+            rows.append((item_id(item), None if modified is None else str(modified), item))
+
+        return self.save(resource, rows, scope)
+
+
+class DoneMarker:
+    # Collects IDs of processed items from any number of threads and marks them done in chunks, so that workers
+    # don't commit a transaction for every item. The rest is marked on exit, also when processing stops on an error
+    def __init__(self, inventory, resource, scope='', chunk_size=DONE_CHUNK_SIZE):
+        self.inventory = inventory
+        self.resource = resource
+        self.scope = scope
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def add(self, item_ids):
+        with self.lock:
+            self.pending.extend(item_ids)
+            if len(self.pending) < self.chunk_size:
+                return
+
+            chunk, self.pending = self.pending, []
+
+        self.inventory.mark_done(self.resource, chunk, self.scope)
+
+    def flush(self):
+        with self.lock:
+            chunk, self.pending = self.pending, []
+
+        if chunk:
+            self.inventory.mark_done(self.resource, chunk, self.scope)
+
+
+def open_inventory(filename, ttl=DEFAULT_TTL):
+    # Inventory of the account and region of the session created by session.create_aws_session
+    from cloud_scripts import session
+
+    return Inventory(filename, session.account_id(), session.region_name(), ttl)
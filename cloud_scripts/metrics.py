@@ -0,0 +1,390 @@
+import os
+import sys
+import json
+import atexit
+import tempfile
+import threading
+from bisect import bisect_left
+from time import monotonic
+from collections import Counter
+
+
+# Upper bounds of latency histogram buckets, in seconds
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.0075, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0, 30.0, float('inf')
+)
+THROTTLING_ERRORS = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'ProvisionedThroughputExceededException',
+    'SlowDown',
+}
+PROMETHEUS_PREFIX = 'cloud_scripts_api'
+
+_operations = {}
+_lock = threading.Lock()
+_local = threading.local()
+_owner_pid = None
+_started = monotonic()
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        # Linear interpolation inside the bucket, capped by the largest observed value
+        rank = q * self.count
+        seen = 0
+
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = LATENCY_BUCKETS[i - 1] if i else 0.0
+                upper = min(LATENCY_BUCKETS[i], self.max)
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+
+        return 0.0
+
+
+class OperationStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.network_errors = 0
+        self.throttled = Counter()
+        # Whole API call including retries and backoff, and every HTTP attempt separately
+        self.latency = Histogram()
+        self.attempt_latency = Histogram()
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.errors += other.errors
+        self.retries += other.retries
+        self.network_errors += other.network_errors
+        self.throttled.update(other.throttled)
+        self.latency.merge(other.latency)
+        self.attempt_latency.merge(other.attempt_latency)
+
+    def client_share(self):
+        # Part of the call time spent outside HTTP attempts: retry backoff, client-side rate limiting,
+        # request building and response parsing
+        if not self.latency.total:
+            return 0.0
+
+        return max(self.latency.total - self.attempt_latency.total, 0.0) / self.latency.total
+
+
+def get_stats(operation_model):
+    key = (operation_model.service_model.service_name, operation_model.name)
+
+    with _lock:
+        if key not in _operations:
+            _operations[key] = OperationStats()
+
+        return _operations[key]
+
+
+def before_call(model, context, **kwargs):
+    # after-call-error is emitted without the operation model, so it is kept in the request context
+    context['metrics_started'] = monotonic()
+    context['metrics_model'] = model
+
+
+def before_send(**kwargs):
+    # Requests are sent synchronously by the calling thread, so the attempt start is kept per thread
+    _local.attempt_started = monotonic()
+
+
+def needs_retry(response, operation, attempts, caught_exception, **kwargs):
+    # Emitted after every attempt, so every attempt after the first one is a retry. Counted here rather than
+    # from RetryAttempts of the response, which calls failing after their retries don't have
+    started = getattr(_local, 'attempt_started', None)
+    stats = get_stats(operation)
+
+    with _lock:
+        if started is not None:
+            stats.attempt_latency.observe(monotonic() - started)
+
+        if attempts > 1:
+            stats.retries += 1
+
+        if caught_exception is not None:
+            stats.network_errors += 1
+        elif response is not None:
+            code = response[1].get('Error', {}).get('Code')
+            if code in THROTTLING_ERRORS:
+                stats.throttled[code] += 1
+
+
+def after_call(context, parsed=None, exception=None, **kwargs):
+    if 'metrics_model' not in context:
+        return
+
+    started = context['metrics_started']
+    stats = get_stats(context['metrics_model'])
+
+    with _lock:
+        stats.calls += 1
+
+        stats.latency.observe(monotonic() - started)
+
+        if exception is not None or (parsed and 'Error' in parsed):
+            stats.errors += 1
+
+
+def after_call_error(context, exception, **kwargs):
+    after_call(context, exception=exception)
+
+
+def instrument(boto3_session):
+    # Handlers have to be registered before clients are created, as clients copy session handlers.
+    # before-send is registered last, so waiting for the adaptive retry rate limiter is not counted as an attempt
+    global _owner_pid
+
+    if _owner_pid != os.getpid():
+        # Pool processes start with a copy of the parent's numbers
+        reset()
+        _owner_pid = os.getpid()
+
+    events = boto3_session.events
+    events.register('before-call', before_call)
+    events.register_last('before-send', before_send)
+    events.register('needs-retry', needs_retry)
+    events.register('after-call', after_call)
+    events.register('after-call-error', after_call_error)
+
+
+def reset():
+    global _started
+
+    with _lock:
+        _operations.clear()
+        _started = monotonic()
+
+
+def drain():
+    # Returns numbers collected so far and starts over; pool workers return this to the parent process
+    with _lock:
+        operations = dict(_operations)
+        _operations.clear()
+
+    return operations
+
+
+def merge(operations):
+    with _lock:
+        for key, stats in operations.items():
+            _operations.setdefault(key, OperationStats()).merge(stats)
+
+
+def print_summary(file=None):
+    with _lock:
+        operations = sorted(_operations.items())
+
+    if not operations:
+        return
+
+    header = (
+        f'{"Operation":<36}{"Calls":>9}{"Errors":>8}{"Retries":>9}{"Throttled":>11}{"Net err":>9}'
+        f'{"p50 ms":>9}{"p99 ms":>9}{"Max ms":>9}{"HTTP p50":>10}{"Client %":>10}'
+    )
+
+    print(f'\nAPI calls in {monotonic() - _started:.1f}s:', file=file)
+    print(header, file=file)
+    print('-' * len(header), file=file)
+
+    for (service, operation), stats in operations:
+        print(
+            f'{service + " " + operation:<36}{stats.calls:>9}{stats.errors:>8}{stats.retries:>9}'
+            f'{sum(stats.throttled.values()):>11}{stats.network_errors:>9}'
+            f'{stats.latency.quantile(0.5) * 1000:>9.1f}{stats.latency.quantile(0.99) * 1000:>9.1f}'
+            f'{stats.latency.max * 1000:>9.1f}{stats.attempt_latency.quantile(0.5) * 1000:>10.1f}'
+            f'{stats.client_share() * 100:>10.1f}',
+            file=file
+        )
+
+    print(
+        'HTTP p50 - median of single HTTP attempts; Client % - share of call time spent outside HTTP attempts '
+        '(retry backoff, client-side rate limiting, request building)',
+        file=file
+    )
+
+
+def histogram_json(histogram):
+    return {
+        'count': histogram.count,
+        'sum': round(histogram.total, 6),
+        'max': round(histogram.max, 6),
+        'p50': round(histogram.quantile(0.5), 6),
+        'p90': round(histogram.quantile(0.9), 6),
+        'p99': round(histogram.quantile(0.99), 6),
+        'buckets': {str(le): n for le, n in zip(LATENCY_BUCKETS, histogram.counts)}
+    }
+
+
+def histogram_from_json(data):
+    histogram = Histogram()
+    histogram.counts = [data['buckets'][str(le)] for le in LATENCY_BUCKETS]
+    histogram.total = data['sum']
+    histogram.max = data['max']
+
+    return histogram
+
+
+def load(filename):
+    # Operations from a JSON file written by save(), f.e. by a script run in a subprocess; pass them to merge()
+    with open(filename) as f:
+        data = json.load(f)
+
+    operations = {}
+    for operation in data['operations']:
+        stats = OperationStats()
+        stats.calls = operation['calls']
+        stats.errors = operation['errors']
+        stats.retries = operation['retries']
+        stats.network_errors = operation['network_errors']
+        stats.throttled.update(operation['throttled'])
+        stats.latency = histogram_from_json(operation['latency'])
+        stats.attempt_latency = histogram_from_json(operation['attempt_latency'])
+        operations[(operation['service'], operation['operation'])] = stats
+
+    return operations
+
+
+def to_json(script):
+    with _lock:
+        operations = sorted(_operations.items())
+
+    return json.dumps({
+        'script': script,
+        'elapsed': round(monotonic() - _started, 3),
+        'operations': [
+            {
+                'service': service,
+                'operation': operation,
+                'calls': stats.calls,
+                'errors': stats.errors,
+                'retries': stats.retries,
+                'network_errors': stats.network_errors,
+                'throttled': dict(stats.throttled),
+                'latency': histogram_json(stats.latency),
+                'attempt_latency': histogram_json(stats.attempt_latency)
+            }
+            for (service, operation), stats in operations
+        ]
+    }, indent=4)
+
+
+def prometheus_histogram(name, labels, histogram):
+    lines = []
+    cumulative = 0
+
+    for le, n in zip(LATENCY_BUCKETS, histogram.counts):
+        cumulative += n
+        bound = '+Inf' if le == float('inf') else str(le)
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+
+    lines.append(f'{name}_sum{{{labels}}} {histogram.total}')
+    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+    return lines
+
+
+def to_prometheus(script):
+    with _lock:
+        operations = sorted(_operations.items())
+
+    metrics = {
+        'calls_total': ('counter', 'API calls made', []),
+        'errors_total': ('counter', 'API calls which failed after all retries', []),
+        'retries_total': ('counter', 'Retried HTTP attempts', []),
+        'network_errors_total': ('counter', 'HTTP attempts failed with a connection or read error', []),
+        'throttles_total': ('counter', 'HTTP attempts rejected with a throttling error', []),
+        'call_duration_seconds': ('histogram', 'API call latency, including retries and backoff', []),
+        'attempt_duration_seconds': ('histogram', 'Latency of a single HTTP attempt', []),
+    }
+
+    for (service, operation), stats in operations:
+        labels = f'script="{script}",service="{service}",operation="{operation}"'
+        metrics['calls_total'][2].append(f'{PROMETHEUS_PREFIX}_calls_total{{{labels}}} {stats.calls}')
+        metrics['errors_total'][2].append(f'{PROMETHEUS_PREFIX}_errors_total{{{labels}}} {stats.errors}')
+        metrics['retries_total'][2].append(f'{PROMETHEUS_PREFIX}_retries_total{{{labels}}} {stats.retries}')
+        metrics['network_errors_total'][2].append(
+            f'{PROMETHEUS_PREFIX}_network_errors_total{{{labels}}} {stats.network_errors}'
+        )
+        for code, n in sorted(stats.throttled.items()):
+            metrics['throttles_total'][2].append(f'{PROMETHEUS_PREFIX}_throttles_total{{{labels},code="{code}"}} {n}')
+        metrics['call_duration_seconds'][2].extend(
+            prometheus_histogram(f'{PROMETHEUS_PREFIX}_call_duration_seconds', labels, stats.latency)
+        )
+        metrics['attempt_duration_seconds'][2].extend(
+            prometheus_histogram(f'{PROMETHEUS_PREFIX}_attempt_duration_seconds', labels, stats.attempt_latency)
+        )
+
+    lines = []
+    for name, (metric_type, description, samples) in metrics.items():
+        lines.append(f'# HELP {PROMETHEUS_PREFIX}_{name} {description}')
+        lines.append(f'# TYPE {PROMETHEUS_PREFIX}_{name} {metric_type}')
+        lines.extend(samples)
+
+    return '\n'.join(lines) + '\n'
+
+
+def save(filename, script):
+    # ".prom" files are written in Prometheus text format (f.e. for node_exporter textfile collector), other files as JSON.
+    # The file is replaced atomically, so a collector never reads a partial file
+    content = to_prometheus(script) if filename.endswith('.prom') else to_json(script)
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_name = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp_name, 0o644)
+        os.replace(tmp_name, filename)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+    print(f'API call metrics saved to {filename}')
+
+
+def report(filename=None, script=None):
+    # Only the process which enabled reporting prints the summary, pool processes exit silently
+    if os.getpid() != _owner_pid:
+        return
+
+    print_summary()
+
+    if filename:
+        save(filename, script)
+
+
+def enable(filename=None):
+    # Prints the summary and saves the metrics file when the script exits, also after an error.
+    # The script name is taken from the running script, which is the same when it is started by cloud-scripts
+    script = os.path.splitext(os.path.basename(getattr(sys.modules['__main__'], '__file__', sys.argv[0])))[0]
+    atexit.register(report, filename, script)
@@ -0,0 +1,207 @@
+import json
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+INT64_RANGE = range(-2 ** 63, 2 ** 63)
+# Attributes which are not in the schema inferred from the first row group, or whose values have another type,
+# are kept in this column as a JSON object
+EXTRA_COLUMN = '_extra'
+SCALAR_TYPES = {
+    'bool': pa.bool_(),
+    'int': pa.int64(),
+    'float': pa.float64(),
+    'str': pa.string(),
+    'bytes': pa.binary(),
+    'datetime': pa.timestamp('us', tz='UTC'),
+    # Maps, lists of mixed values and columns with conflicting types are written as JSON strings
+    'json': pa.string(),
+}
+
+
+def json_default(value):
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=str)
+    if isinstance(value, bytes):
+        return value.hex()
+
+    return str(value)
+
+
+def to_json(value):
+    if value is None or isinstance(value, str):
+        return value
+
+    return json.dumps(value, default=json_default, sort_keys=True)
+
+
+def value_type(value):
+    # Type of a column which can hold the value; None for values which say nothing about it
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    if isinstance(value, str):
+        return 'str'
+    if isinstance(value, (bytes, bytearray)):
+        return 'bytes'
+    if isinstance(value, datetime):
+        return 'datetime'
+    if isinstance(value, (set, frozenset, list, tuple)):
+        element_type = None
+        for element in value:
+            element_type = merge_types(element_type, value_type(element))
+
+        if element_type is None:
+            return None
+        if element_type in ('json', 'datetime') or element_type.startswith('list'):
+            return 'json'
+
+        return f'list:{element_type}'
+
+    # Maps, Decimal and other objects
+    return 'json'
+
+
+def merge_types(a, b):
+    if a is None or a == b:
+        return b
+    if b is None:
+        return a
+    if {a, b} == {'int', 'float'}:
+        return 'float'
+    if {a, b} == {'list:int', 'list:float'}:
+        return 'list:float'
+
+    return 'json'
+
+
+def arrow_type(column_type):
+    if column_type.startswith('list:'):
+        return pa.list_(SCALAR_TYPES[column_type[5:]])
+
+    return SCALAR_TYPES[column_type]
+
+
+def fits(column_type, value):
+    # Whether a value can be written to a column of the type; values of other types go to the extra column
+    if value is None or column_type == 'json':
+        return True
+    if column_type == 'int' and value_type(value) == 'int':
+        return value in INT64_RANGE
+
+    return merge_types(column_type, value_type(value)) == column_type
+
+
+def converter(column_type):
+    if column_type == 'json':
+        return to_json
+    if column_type.startswith('list:'):
+        return lambda value: sorted(value) if isinstance(value, (set, frozenset)) else value
+
+    return None
+
+
+class ParquetSink:
+    # Writes rows to a Parquet file one row group at a time, so memory is bounded by the row group size.
+    # Column types are inferred from the first row group; columns are optional, known upfront column names
+    # which get a column even when the first row group has no values for them, or a mapping of names to
+    # column types ('str', 'int', 'float', 'bool', 'datetime', ...; None is inferred) which override inference
+    def __init__(self, filename, row_group_size=100000, compression='snappy', columns=()):
+        self.filename = filename
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.known_columns = dict(columns) if isinstance(columns, dict) else dict.fromkeys(columns)
+        self.rows = []
+        self.writer = None
+        self.types = None
+        self.rows_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, rows):
+        self.rows.extend(rows)
+
+        while len(self.rows) >= self.row_group_size:
+            self.write_row_group(self.rows[:self.row_group_size])
+            del self.rows[:self.row_group_size]
+
+    def close(self):
+        if self.rows or not self.writer:
+            self.write_row_group(self.rows)
+            self.rows = []
+
+        self.writer.close()
+
+    def open(self, rows):
+        types = {}
+        for row in rows:
+            for name, value in row.items():
+                types[name] = merge_types(types.get(name), value_type(value))
+
+        for name, column_type in self.known_columns.items():
+            types[name] = column_type or types.get(name)
+
+        # Columns without a single value in the first row group can still get any values later
+        self.types = {name: column_type or 'json' for name, column_type in types.items() if name != EXTRA_COLUMN}
+
+        schema = pa.schema(
+            [(name, arrow_type(column_type)) for name, column_type in self.types.items()] + [(EXTRA_COLUMN, pa.string())]
+        )
+        self.writer = pq.ParquetWriter(self.filename, schema, compression=self.compression)
+
+    def write_row_group(self, rows):
+        if not self.writer:
+            self.open(rows)
+
+        extras = [{} for _ in rows]
+        arrays = []
+
+        for name, column_type in self.types.items():
+            convert = converter(column_type)
+            values = [row.get(name) for row in rows]
+            if convert:
+                values = [convert(value) for value in values]
+
+            try:
+                arrays.append(pa.array(values, type=arrow_type(column_type)))
+            except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+                values = self.move_mismatched(name, column_type, values, rows, extras)
+                arrays.append(pa.array(values, type=arrow_type(column_type)))
+
+        for row, extra in zip(rows, extras):
+            for name, value in row.items():
+                if name not in self.types:
+                    extra[name] = value
+
+        arrays.append(pa.array([to_json(extra) if extra else None for extra in extras], type=pa.string()))
+
+        self.writer.write_table(
+            pa.Table.from_arrays(arrays, schema=self.writer.schema),
+            row_group_size=self.row_group_size
+        )
+        self.rows_written += len(rows)
+
+    @staticmethod
+    def move_mismatched(name, column_type, values, rows, extras):
+        # Slow path for a row group with values of another type than the column: they go to the extra column
+        kept = []
+
+        for i, value in enumerate(values):
+            if fits(column_type, value):
+                kept.append(value)
+            else:
+                extras[i][name] = rows[i][name]
+                kept.append(None)
+
+        return kept
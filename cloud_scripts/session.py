@@ -0,0 +1,73 @@
+import threading
+
+from cloud_scripts import metrics
+
+
+# botocore default connection pool size, used when a client is not shared by more threads
+DEFAULT_POOL_CONNECTIONS = 10
+# Adaptive mode adds client-side rate limiting on top of standard retries, which backs off on throttling
+RETRY_MODE = 'adaptive'
+MAX_ATTEMPTS = 10
+
+_session = None
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def create_aws_session(region, profile_name=None):
+    # One session per process: clients created from it share a single botocore session,
+    # so service models are loaded once. Pool workers call this again in their initializer
+    global _session
+
+    # boto3 is imported only when a session is created, so scripts start fast for -h and argument errors
+    import boto3
+
+    if profile_name:
+        print(f'Using profile {profile_name}\n')
+    else:
+        print('Using default profile')
+
+    with _lock:
+        _session = boto3.session.Session(
+            region_name=region,
+            profile_name=profile_name
+        )
+        metrics.instrument(_session)
+
+    return _session
+
+
+def client_config(max_pool_connections=None, retries=None):
+    from botocore.config import Config
+
+    return Config(
+        max_pool_connections=max_pool_connections or DEFAULT_POOL_CONNECTIONS,
+        retries=retries or {'mode': RETRY_MODE, 'max_attempts': MAX_ATTEMPTS}
+    )
+
+
+def client(service_name, max_pool_connections=None, retries=None):
+    # Size max_pool_connections to the number of threads sharing the client. retries replaces the default
+    # retry config, f.e. for callers which retry and pace requests themselves.
+    # Sessions are not thread-safe, clients created from them are
+    with _lock:
+        return _session.client(service_name, config=client_config(max_pool_connections, retries))
+
+
+def thread_client(service_name):
+    # Client owned by the calling worker thread; it sends one request at a time, so one connection is enough
+    clients = _local.__dict__.setdefault('clients', {})
+    key = (id(_session), service_name)
+
+    if key not in clients:
+        clients[key] = client(service_name, max_pool_connections=1)
+
+    return clients[key]
+
+
+def region_name():
+    return _session.region_name
+
+
+def account_id():
+    return client('sts').get_caller_identity()['Account']
@@ -0,0 +1,229 @@
+import os
+import gzip
+import json
+import threading
+from queue import Queue
+
+
+# Suffix added to names of written parts
+COMPRESSION_SUFFIXES = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+# Number of written record batches which may wait for the writing thread
+QUEUE_SIZE = 16
+# Encoded records are passed to the file in chunks of up to this size, the part size is checked after every chunk
+WRITE_CHUNK_BYTES = 1024 * 1024
+
+
+def zstd_writer(raw):
+    # The standard library has zstd since Python 3.14, older versions need the zstandard package
+    try:
+        from compression import zstd
+
+        return zstd.ZstdFile(raw, 'wb')
+    except ImportError:
+        pass
+
+    import zstandard
+
+    return zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+
+
+def zstd_available():
+    try:
+        from compression import zstd  # noqa: F401
+    except ImportError:
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            return False
+
+    return True
+
+
+def default_encode(record):
+    return json.dumps(record, sort_keys=True, default=str)
+
+
+class Part:
+    def __init__(self, filename, compression):
+        self.filename = filename
+        self.raw = open(filename, 'wb')
+        self.records = 0
+        self.uncompressed_bytes = 0
+
+        if compression == 'gzip':
+            self.file = gzip.GzipFile(fileobj=self.raw, mode='wb', compresslevel=6)
+        elif compression == 'zstd':
+            self.file = zstd_writer(self.raw)
+        else:
+            self.file = self.raw
+
+    @property
+    def size(self):
+        # Bytes passed to the file so far; lags behind by what the compressor keeps in its buffer
+        return self.raw.tell()
+
+    def write(self, data, records):
+        self.file.write(data)
+        self.records += records
+        self.uncompressed_bytes += len(data)
+
+    def sync(self):
+        # Compressors flush a complete block, so everything written so far can be decompressed from the file
+        if self.file is not self.raw:
+            self.file.flush()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+
+    def close(self):
+        if self.file is not self.raw:
+            self.file.close()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.raw.close()
+
+        return {
+            'file': os.path.basename(self.filename),
+            'records': self.records,
+            'bytes': os.path.getsize(self.filename),
+            'uncompressed_bytes': self.uncompressed_bytes,
+        }
+
+
+class JsonLinesSink:
+    # Writes records as JSON lines, optionally compressed and split into parts of limited size or number of records.
+    # Records are encoded, compressed and written by a background thread, so callers only wait when the queue is full.
+    # A manifest with the written parts is saved next to them every time a part is completed
+    def __init__(self, filename, compression=None, max_bytes=None, max_records=None, encode=default_encode):
+        self.filename = filename
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.encode = encode
+        self.rotates = bool(max_bytes or max_records)
+        self.manifest_file = os.path.splitext(filename)[0] + '.manifest.json'
+
+        self.parts = []
+        self.part = None
+        self.records = 0
+        self.error = None
+        self.queue = Queue(maxsize=QUEUE_SIZE)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, records):
+        self.check()
+        self.queue.put(('write', records))
+
+    def sync(self):
+        # Blocks until everything written so far is on disk
+        done = threading.Event()
+        self.queue.put(('sync', done))
+        done.wait()
+        self.check()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+        self.check()
+
+    def check(self):
+        if self.error:
+            raise self.error
+
+    def part_name(self):
+        stem, ext = os.path.splitext(self.filename)
+        name = f'{stem}-{len(self.parts) + 1:05d}{ext}' if self.rotates else self.filename
+
+        return name + COMPRESSION_SUFFIXES[self.compression]
+
+    def run(self):
+        while (command := self.queue.get()) is not None:
+            # After an error, keep taking commands so callers are never blocked; they get the error on next call
+            if self.error:
+                if command[0] == 'sync':
+                    command[1].set()
+                continue
+
+            try:
+                if command[0] == 'write':
+                    self.write_records(command[1])
+                else:
+                    if self.part:
+                        self.part.sync()
+                    command[1].set()
+            except Exception as e:
+                self.error = e
+                if command[0] == 'sync':
+                    command[1].set()
+
+        try:
+            if self.part or not self.parts:
+                self.complete_part()
+            self.save_manifest(complete=True)
+        except Exception as e:
+            self.error = self.error or e
+
+    def write_records(self, records):
+        # The compressed size is known only once data is passed to the compressor, so compressed parts are checked
+        # after every chunk; uncompressed parts end at the record which reaches the limit
+        lines = []
+        pending = 0
+
+        for record in records:
+            if self.part is None:
+                self.part = Part(self.part_name(), self.compression)
+
+            line = (self.encode(record) + '\n').encode()
+            lines.append(line)
+            pending += len(line)
+
+            full = (self.max_records and self.part.records + len(lines) >= self.max_records) or \
+                (self.max_bytes and not self.compression and self.part.size + pending >= self.max_bytes)
+
+            if full or pending >= WRITE_CHUNK_BYTES:
+                self.write_lines(lines, full)
+                lines = []
+                pending = 0
+
+        if lines:
+            self.write_lines(lines)
+
+    def write_lines(self, lines, full=False):
+        self.part.write(b''.join(lines), len(lines))
+        self.records += len(lines)
+
+        if full or (self.max_bytes and self.part.size >= self.max_bytes):
+            self.complete_part()
+
+    def complete_part(self):
+        if self.part is None:
+            self.part = Part(self.part_name(), self.compression)
+
+        self.parts.append(self.part.close())
+        self.part = None
+        self.save_manifest(complete=False)
+
+    def save_manifest(self, complete):
+        manifest = {
+            'compression': self.compression,
+            'records': sum(part['records'] for part in self.parts),
+            'complete': complete,
+            'parts': self.parts,
+        }
+
+        with open(self.manifest_file + '.tmp', 'w') as file:
+            json.dump(manifest, file, indent=4)
+
+        os.replace(self.manifest_file + '.tmp', self.manifest_file)